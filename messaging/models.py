@@ -24,9 +24,16 @@ from __future__ import print_function
 import hashlib
 import ast
 import json
+import operator
+import threading
+from collections import OrderedDict
 from decimal import Decimal
+from time import time as timestamp
+from uuid import UUID
 
 from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+from django.dispatch import Signal
 
 # Standard model imports
 from django.contrib.auth.models import User
@@ -40,6 +47,8 @@ from django.template.loader import render_to_string
 from string import Template
 
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Case, When, Value
 from django.db.models.query import QuerySet
 from django.conf import settings
 
@@ -49,6 +58,12 @@ try:
 except ImportError:
     import pickle
 
+# optional C accelerated json encoder, see json_backend
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
 # Errors
 
 class Error(Exception):
@@ -103,8 +118,18 @@ class JSONEncoder(DjangoJSONEncoder):
     The Django encoder already deals with date/datetime objects.
     Additionally, this encoder uses an 'as_dict' or 'as_list' attribute or
     method of an object, if provided. It also makes lists from QuerySets.
+    The handler for each type is looked up once and kept in handlers.
     '''
+    handlers = {}
+
     def default(self, obj):
+        try:
+            handler = self.handlers[type(obj)]
+        except KeyError:
+            handler = self.handlers[type(obj)] = json_handler(type(obj))
+        return handler(self, obj)
+
+    def probe(self, obj):
         if hasattr(obj, 'as_dict'):
             return maybe_call(obj.as_dict)
         elif hasattr(obj, 'as_list'):
@@ -113,6 +138,50 @@ class JSONEncoder(DjangoJSONEncoder):
             return list(obj)
         return super(JSONEncoder, self).default(obj)
 
+def json_handler(cls):
+    '''
+    JSONEncoder handler for objects of type cls, types not known here fall
+    back to probing each object as the encoder used to.
+    '''
+    if hasattr(cls, 'as_dict'):
+        return lambda encoder, obj: maybe_call(obj.as_dict)
+    if hasattr(cls, 'as_list'):
+        return lambda encoder, obj: maybe_call(obj.as_list)
+    if issubclass(cls, QuerySet):
+        return lambda encoder, obj: list(obj)
+    if issubclass(cls, (datetime, date, time, Decimal, UUID)):
+        return DjangoJSONEncoder.default
+    return JSONEncoder.probe
+
+def stdlib_dumps(obj, sort_keys=False):
+    return json.dumps(obj, cls=JSONEncoder, sort_keys=sort_keys)
+
+def simplejson_dumps(obj, sort_keys=False):
+    # Decimals and namedtuples are left to the encoder, as json does
+    return simplejson.dumps(obj, default=JSONEncoder().default, sort_keys=sort_keys,
+        use_decimal=False, namedtuple_as_object=False)
+
+# fastest first, simplejson's C speedups are used when it is installed
+JSON_BACKENDS = [("json", stdlib_dumps)]
+if simplejson is not None:
+    JSON_BACKENDS.insert(0, ("simplejson", simplejson_dumps))
+
+def json_backend(name=None):
+    '''
+    dumps function of the JSON_BACKEND setting, or the fastest one installed
+    '''
+    backends = dict(JSON_BACKENDS)
+    name = name or getattr(settings, "JSON_BACKEND", None)
+    if name in backends:
+        return backends[name]
+    return JSON_BACKENDS[0][1]
+
+def dumps(obj, sort_keys=False):
+    '''
+    JSON text of obj through JSONEncoder, using the json_backend()
+    '''
+    return json_backend()(obj, sort_keys=sort_keys)
+
 class JSONField(models.TextField):
     """JSONField is a generic textfield that neatly serializes/unserializes
     JSON objects seamlessly"""
@@ -157,6 +226,94 @@ class JSONField(models.TextField):
         return super(JSONField, self).get_db_prep_save(value, connection)
 
 
+class JSONText(unicode):
+    '''
+    JSON text as loaded from the database, known to be valid so it can be
+    written back or sent out without being decoded.
+    '''
+    pass
+
+class LazyJSON(object):
+    '''
+    Instance state of a LazyJSONField: the raw text, decoded on first
+    access and then kept. changed is set when the value is assigned.
+    '''
+    def __init__(self, text=None, value=None, changed=False):
+        self.text = text
+        self.value = value
+        self.decoded = text is None
+        self.changed = changed
+
+    def get(self, field):
+        if not self.decoded:
+            self.value = field.to_python(self.text)
+            self.decoded = True
+        return self.value
+
+    def unchanged(self, field):
+        '''
+        True if the stored text still represents the value, values that
+        have been read may have been changed in place so are compared.
+        '''
+        if self.changed or not isinstance(self.text, JSONText):
+            return False
+        return not self.decoded or self.value == field.to_python(self.text)
+
+class LazyJSONDescriptor(object):
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.__dict__[self.field.attname].get(self.field)
+
+    def __set__(self, instance, value):
+        if isinstance(value, LazyJSON):
+            state = value
+        elif isinstance(value, basestring):
+            # text from the database is trusted, anything else is checked on save
+            state = LazyJSON(text=value, changed=not isinstance(value, JSONText))
+        else:
+            state = LazyJSON(value=value, changed=True)
+        instance.__dict__[self.field.attname] = state
+
+class LazyJSONField(models.TextField):
+    '''
+    JSONField that keeps the text loaded from the database and only decodes
+    it when the attribute is first read. Values that weren't assigned or
+    changed are saved (and can be served) as the original text.
+    '''
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(LazyJSONField, self).contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.attname, LazyJSONDescriptor(self))
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return value
+        return JSONText(value)
+
+    to_python = JSONField.to_python.__func__
+    from_python = JSONField.from_python.__func__
+
+    def pre_save(self, model_instance, add):
+        state = model_instance.__dict__[self.attname]
+        if state.unchanged(self):
+            return state.text
+        return state.get(self)
+
+    def get_db_prep_save(self, value, connection, prepared=False):
+        if not isinstance(value, JSONText):
+            value = self.from_python(value)
+        return super(LazyJSONField, self).get_db_prep_save(value, connection)
+
+    def value_to_string(self, obj):
+        state = obj.__dict__[self.attname]
+        if state.unchanged(self):
+            return state.text
+        return self.from_python(state.get(self))
+
+
 class SelectAutoComplete(forms.Select):
     '''
     Needs jquery UI, jLinq
@@ -192,12 +349,73 @@ class SelectAutoComplete(forms.Select):
         '''.format(json.dumps(choiceArray).replace("&", "&amp;"), final_attrs, value, delay, minLength, label))
         return mark_safe(u'\n'.join(output))
 
+# request local first level for audit_cache, only kept during a request so
+# management commands and workers always see the shared cache
+audit_local = threading.local()
+MISSING = object()
+
+def start_audit_local(**kwargs):
+    audit_local.cache = {}
+
+def finish_audit_local(**kwargs):
+    audit_local.cache = None
+
+request_started.connect(start_audit_local, dispatch_uid="audit_local_started")
+request_finished.connect(finish_audit_local, dispatch_uid="audit_local_finished")
+
+# sent once, with the model as sender, after versions are changed in bulk
+# (AuditManager.bulk_save_versions, manage.py repair_versions) in place of
+# post_save for each row, so caches over a whole model are dropped once
+versions_changed = Signal(providing_args=["instances"])
+
+def cache_version(key):
+    '''
+    Version counter kept in the cache at key, made part of the keys of the
+    entries it covers so bump_cache_version drops them all with one incr.
+    Starts from the current time so a lost counter can't bring back keys
+    from an older version.
+    '''
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(timestamp() * 1000), None)
+        version = cache.get(key, int(timestamp() * 1000))
+    return version
+
+def bump_cache_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(timestamp() * 1000), None)
+
+def audit_version(sha1):
+    '''
+    cache_version of a version set, part of every audit_cache key for it
+    so clear_cache() drops them all at once
+    '''
+    local = getattr(audit_local, "cache", None)
+    if local is not None and ("version", sha1) in local:
+        return local[("version", sha1)]
+    version = cache_version("audit.{0}.version".format(sha1))
+    if local is not None:
+        local[("version", sha1)] = version
+    return version
+
+def bump_audit_version(sha1):
+    bump_cache_version("audit.{0}.version".format(sha1))
+    local = getattr(audit_local, "cache", None)
+    if local is not None:
+        local.pop(("version", sha1), None)
+
 def audit_cache(seconds = 3600):
     '''
-    Cache for inside audit objects
+    Cache for inside audit objects, one key per object version set, function
+    and arguments, looked up in a request local cache first. The request
+    local cache holds pickles, so like the shared cache each call returns
+    its own copy and changes to one result can't leak into the next.
     Note that the ordering of parameters is important.
     e.g. myFunction(x = 1, y = 2), myFunction(y = 2, x = 1),
     and myFunction(1,2) will each be cached separately.
+    QuerySets are returned uncached as they are still to be evaluated.
 
     Usage:
 
@@ -207,16 +425,23 @@ def audit_cache(seconds = 3600):
         return expensiveResult
     '''
     def doCache(f):
+        name = unicode(f.__module__) + unicode(f.__name__)
         def x(self, *args, **kwargs):
-                key = self.sha1()
-                hashkey = hashlib.sha1(unicode(f.__module__) + unicode(f.__name__) + unicode(args) + unicode(kwargs)).hexdigest()
-                result = cache.get(key)
-                if result is None:
-                    result = {}
-                if not result.has_key(hashkey):
-                    result[hashkey] = f(self, *args, **kwargs)
+                sha1 = self.sha1()
+                hashkey = hashlib.sha1(name + unicode(args) + unicode(kwargs)).hexdigest()
+                key = "audit.{0}.{1}.{2}".format(sha1, audit_version(sha1), hashkey)
+                local = getattr(audit_local, "cache", None)
+                if local is not None and key in local:
+                    return pickle.loads(local[key])
+                result = cache.get(key, MISSING)
+                if result is MISSING:
+                    result = f(self, *args, **kwargs)
+                    if isinstance(result, QuerySet):
+                        return result
                     cache.set(key, result, seconds)
-                return result[hashkey]
+                if local is not None:
+                    local[key] = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+                return result
         return x
     return doCache
 
@@ -235,6 +460,85 @@ class AuditManager(models.GeoManager):
     def current(self):
         return self.filter(effective_to = None)
 
+    def bulk_save_versions(self, objects, user = None, validate = True, batch_size = 500):
+        '''
+        save_version() for many objects at once. Existing versions for all
+        their natural keys are loaded in a few queries and the timeline
+        worked out in memory, then in one transaction the superseded rows
+        are ended with a single UPDATE per batch and the new rows inserted
+        with bulk_create. Objects without an effective_from start now.
+
+        Raises AuditCollision, and saves nothing, if an object is the same
+        as the version it would replace (see Audit.compare) or shares its
+        effective_from. No save signals are sent for the rows, instead
+        versions_changed is sent once with the new versions. Returns the
+        new versions, as with bulk_create their pk isn't set unless the
+        model is multi table inherited.
+        '''
+        now = datetime.utcnow()
+        sets = OrderedDict()
+        for obj in objects:
+            obj.pk = obj.id = None
+            obj.effective_from = obj.effective_from or now
+            obj.effective_to = None
+            if user:
+                obj.created_by = obj.modified_by = user
+            sets.setdefault(tuple(obj.natural_key()[1:]), []).append(obj)
+        keys = list(sets)
+        existing = dict((key, []) for key in keys)
+        for i in range(0, len(keys), batch_size):
+            versions = reduce(operator.or_, [self.natural_key_set(*sets[key][0].natural_key()) for key in keys[i:i + batch_size]])
+            for version in versions:
+                existing.setdefault(tuple(version.natural_key()[1:]), []).append(version)
+        ended, created = [], []
+        for key in keys:
+            timeline = existing[key]
+            for obj in sorted(sets[key], key=lambda obj: obj.effective_from):
+                start = obj.effective_from
+                previous = [v for v in timeline if v.effective_from <= start and (v.effective_to is None or v.effective_to > start)]
+                if len(previous) > 1:
+                    raise AuditError(
+                        "oh no multiple active versions detected\n"
+                        "please run manage.py repair_versions {0}.{1}\n"
+                        "{2}".format(self.model._meta.app_label, self.model._meta.object_name, obj.natural_key())
+                    )
+                if previous:
+                    previous = previous[0]
+                    if previous.effective_from == start or (validate and obj.compare(previous)):
+                        raise AuditCollision(unicode(previous) + ", " + unicode(obj))
+                    previous.effective_to = start
+                    if user:
+                        previous.modified_by = user
+                    if previous.pk is not None:
+                        ended.append(previous)
+                later = [v.effective_from for v in timeline if v.effective_from > start]
+                obj.effective_to = min(later) if later else None
+                timeline.append(obj)
+                created.append(obj)
+        # effective_to is on the concrete parent for multi table inherited models
+        model = self.model._meta.get_field("effective_to").model
+        with transaction.atomic(using=self.db):
+            for i in range(0, len(ended), batch_size):
+                batch = ended[i:i + batch_size]
+                update = {"effective_to": Case(*[When(pk=v.pk, then=Value(v.effective_to)) for v in batch],
+                    output_field=models.DateTimeField())}
+                if user:
+                    update["modified_by"] = user
+                model._base_manager.using(self.db).filter(pk__in=[v.pk for v in batch]).update(**update)
+            if self.model._meta.parents:
+                # bulk_create can't insert into parent tables, these are the
+                # inserts of save_base without its pre_save/post_save signals
+                for obj in created:
+                    obj._save_parents(obj.__class__, self.db, None)
+                    obj._save_table(cls=obj.__class__, force_insert=True, using=self.db)
+                    obj._state.db, obj._state.adding = self.db, False
+            else:
+                self.bulk_create(created, batch_size=batch_size)
+        for key in keys:
+            sets[key][0].clear_cache()
+        versions_changed.send(sender=self.model, instances=created)
+        return created
+
 class Audit(models.Model):
     '''
     Contains the effective_from, effective_to,
@@ -261,37 +565,12 @@ class Audit(models.Model):
     effective_to = models.DateTimeField(db_index=True, null=True, blank=True)
 
     def fix_versions(self):
-        nkey = self.natural_key()
-        versions = self._default_manager.natural_key_set(*nkey)
-        resetnone = False
-        if len(versions.filter(effective_to = None)) > 1:
-            print("multiple active records, trying to adjust effective_to's")
-            resetnone = True
-        if len(versions.filter(effective_from = self.effective_from)) > 1:
-            print([v.pk for v in versions])
-        for version in versions:
-            if version.effective_to != None and version.effective_from > version.effective_to:
-                print(version.effective_to - version.effective_from)
-                version.effective_to = version.effective_from
-                version.save()
-            if resetnone and version.effective_to == None:
-                fixed = False
-                hop = 1
-                while not fixed:
-                    try:
-                        version.effective_to = version.get_version(version.effective_from, "next")
-                        version.save()
-                        fixed = True
-                    except:
-                        try:
-                            version.effective_from += timedelta(seconds=hop)
-                            version.effective_to = version.get_version(version.effective_from, "next")
-                            version.save()
-                            fixed = True
-                        except Exception, e:
-                            hop += 1
-                            print(`e`, hop)
-        print('.', end="")
+        '''
+        Repairs the versions of this objects model, see manage.py
+        repair_versions which it runs
+        '''
+        from django.core.management import call_command
+        call_command("repair_versions", "{0}.{1}".format(self._meta.app_label, self._meta.object_name))
 
     @audit_cache()
     def get_version(self, fromdate = None, todate = None):
@@ -328,8 +607,8 @@ class Audit(models.Model):
                 if versions.filter(effective_to = None):
                     raise AuditError(
                         "oh no multiple active versions detected\n"
-                        "please run object.fix_versions()\n"
-                        "{0}".format(nkey)
+                        "please run manage.py repair_versions {0}.{1}\n"
+                        "{2}".format(self._meta.app_label, self._meta.object_name, nkey)
                     )
                 else:
                     raise
@@ -484,7 +763,7 @@ class Audit(models.Model):
         return hashlib.sha1(repr(self.natural_key()[1:])).hexdigest()
 
     def clear_cache(self):
-        cache.set(self.sha1(), None, 0)
+        bump_audit_version(self.sha1())
 
     def __unicode__(self):
         return unicode(self.pk) + ":" + self.natural_key_str()
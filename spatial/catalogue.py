@@ -0,0 +1,306 @@
+'''
+The layer catalogue served to the map: tracking layers, system layers in
+layerorder.json order and the users own layers, plus a static snapshot
+of the shared part built by manage.py build_layer_catalogue, which
+clients can load from the static server instead of layers.json. Saves
+touch a marker file (see spatial.models.touch_catalogue_marker) so the
+command only rebuilds the snapshot after a change.
+'''
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from messaging.models import dumps
+from spatial.models import CATALOGUE_MARKER, Map, RasterLayer
+from spatial.utils import layer_order
+
+# cache key holding the file name of the current snapshot
+SNAPSHOT_KEY = "layercatalogue.snapshot"
+SNAPSHOT_POINTER = "layers.current"
+SNAPSHOT_PATTERN = re.compile(r"^layers\.[0-9a-f]{12}\.json$")
+# seconds superseded snapshots are kept for pages still loading them
+SNAPSHOT_KEEP = 86400
+
+
+TRACKING_LAYERS = [{
+            "tags": "resource, tracking, week, symbols, default",
+            "style": "resource_tracking_symbols",
+            "style_history": "",
+            "cluster": 12,
+            "filters": None,
+            "query": "resource_tracking_week",
+            "unique": "deviceid",
+            "id": "resource_tracking_week_symbols_overlay",
+            "legend": "//static.dpaw.wa.gov.au/static/firesource/static/source/legends/resource_tracking_week_symbols_overlay.png",
+            "shown": True,
+            "name": "Resource Tracking - Symbols Overlay",
+            "details":
+        {
+            "updated": "Live",
+            "renderer": "layerdetails",
+            "legend_width": 600,
+            "tags": [
+                    "resource",
+                    "tracking",
+                    "week",
+                    "symbols"
+                ]
+            },
+            "type": "vectoroverlay"
+        }, {
+            "tags": "resource, tracking, week, default",
+            "style": "resource_tracking",
+            "style_history": "vector_history",
+            "cluster": 12,
+            "filters":
+            {
+                "Comms Bus": "symbol:device_comms_bus",
+                "Heavy Duty": "symbol:device_heavy_duty",
+                "Dozer": "symbol:device_dozer",
+                "Gang Truck": "symbol:device_gang_truck",
+                "Aviation": "group:aviation"
+            },
+            "query": "resource_tracking_week",
+            "unique": "deviceid",
+            "id": "resource_tracking_week_base",
+            "legend": "//static.dpaw.wa.gov.au/static/firesource/static/source/legends/resource_tracking_week_base.png",
+            "shown": True,
+            "name": "Resource Tracking",
+            "details":
+            {
+                "updated": "Live",
+                "positionalaccuracy": "Unknown",
+                "description": "Resource tracking data showing points within the last week",
+                "tags": [
+                        "resource",
+                        "tracking",
+                        "week"
+                    ],
+                    "custodian": "DPAW",
+                    "legend_width": 400,
+                    "source": "DPAW",
+                    "renderer": "layerdetails"
+                },
+                "type": "vector"
+        }]
+
+
+def system_layers(order):
+    '''
+    The shared part of the catalogue, layers listed in layerorder.json in
+    file order plus the rest of those maintained by the system user, by
+    type. Loaded in one query and grouped here.
+    '''
+    layer_types = ["point", "line", "polygon", "overlay", "imagery"] #nice ordering
+    catalogue = list(RasterLayer.objects.filter(effective_to = None).order_by("name"))
+    dictlayers = dict((layer_type, []) for layer_type in layer_types)
+    others = dict((layer_type, []) for layer_type in layer_types)
+    versions = {}
+    for layer in catalogue:
+        if layer.layer_id in order.ids:
+            versions[layer.layer_id] = versions.get(layer.layer_id, 0) + 1
+    # ids with more than one current version are skipped, as get() would
+    ordered = [layer for layer in catalogue if versions.get(layer.layer_id) == 1]
+    for layer in sorted(ordered, key=lambda layer: order.index[layer.layer_id]):
+        if layer.layer_type in dictlayers:
+            dictlayers[layer.layer_type].append(layer)
+    for layer in catalogue:
+        if layer.modified_by_id == 1 and layer.layer_id not in order.ids and layer.layer_type in others:
+            others[layer.layer_type].append(layer)
+    layers = []
+    for layer_type in layer_types:
+        layers += dictlayers[layer_type]
+        layers += others[layer_type]
+    return layers
+
+
+def user_layers(request, order):
+    '''
+    The users own layers, only listed with the old (retro) ordering
+    '''
+    layers = []
+    if order.layers is None:
+        # Vector layers outside of editable rasters should be deprecated soon
+        for layer_type in ["point", "line", "polygon", "overlay", "imagery"]: #nice ordering
+            layers += list(RasterLayer.objects.filter(effective_to=None, created_by=request.user, layer_type=layer_type).order_by("-date_created").exclude(layer_id__contains=request.user.username + "_resource_tracking"))
+    return layers
+
+
+MAP_FIELDS = ("name", "layers", "tags", "immutable", "map_type", "scale", "map_id", "workdir", "created_by_id")
+
+
+def map_rows(queryset, params=None):
+    '''
+    The columns map_json needs for the maps in queryset, center as x/y
+    straight from the database rather than a GEOS geometry per row. params
+    (usually request.GET) can filter on q (name, map_id or tags), type and
+    tag, and page with offset and limit, queryset should have a unique
+    ordering to page on. Returns (rows, total), raises ValueError if offset
+    or limit isn't a whole number.
+    '''
+    params = params or {}
+    if params.get("q"):
+        q = params["q"]
+        queryset = queryset.filter(Q(name__icontains=q) | Q(map_id__icontains=q) | Q(tags__icontains=q))
+    if params.get("type"):
+        queryset = queryset.filter(map_type=params["type"])
+    if params.get("tag"):
+        queryset = queryset.filter(tags__icontains=params["tag"])
+    total = None
+    offset, limit = int(params.get("offset") or 0), int(params.get("limit") or 0)
+    if offset < 0 or limit < 0:
+        raise ValueError("offset and limit can't be negative")
+    if offset or limit:
+        total = queryset.count()
+        queryset = queryset[offset:offset + limit if limit else None]
+    center = '"{0}"."center"'.format(Map._meta.db_table)
+    rows = queryset.extra(select={"center_x": "ST_X({0})".format(center), "center_y": "ST_Y({0})".format(center)})
+    rows = list(rows.values(*MAP_FIELDS + ("center_x", "center_y")))
+    return rows, len(rows) if total is None else total
+
+
+def map_json(row, user=None):
+    '''
+    Map.as_json for a map_rows row, layers left as the stored JSON text
+    '''
+    return {
+        "name": row["name"],
+        "layers": row["layers"] or "null",
+        "tags": row["tags"],
+        "immutable": row["immutable"] or (user is not None and user.pk != row["created_by_id"]),
+        "type": row["map_type"],
+        "center": {"type": "Point", "coordinates": [row["center_x"], row["center_y"]]},
+        "scale": row["scale"],
+        "map_id": row["map_id"],
+        "url": "/apps/spatial/map/{0}_{1}".format(row["map_id"], (row["workdir"] or "").split("/")[-1])
+    }
+
+
+def maps_dict(rows, user=None):
+    maps = []
+    for row in rows:
+        jsonmap = map_json(row, user)
+        jsonmap["layers"] = json.loads(jsonmap["layers"])
+        maps.append(jsonmap)
+    return maps
+
+
+def maps_text(rows, user=None):
+    '''
+    JSON text of a list of maps, with each maps stored layers spliced in
+    as is instead of being decoded and encoded again
+    '''
+    maps = []
+    for row in rows:
+        jsonmap = map_json(row, user)
+        layers = jsonmap.pop("layers")
+        maps.append(dumps(jsonmap)[:-1] + ', "layers": ' + layers + "}")
+    return "[" + ", ".join(maps) + "]"
+
+
+def snapshot():
+    '''
+    The shared catalogue as served by layer_list(fmt="json") to users other
+    than the system user: tracking and system layers, and the system maps
+    (immutable for everyone but their creator). None when layerorder.json
+    is missing, as the old ordering mixes in each users own layers.
+    '''
+    order = layer_order()
+    if order.layers is None:
+        return None
+    maps = maps_dict(map_rows(Map.objects.filter(created_by=1, effective_to=None).order_by("created_by", "name", "pk"))[0])
+    for jsonmap in maps:
+        jsonmap["immutable"] = True
+    return {
+        "layers": TRACKING_LAYERS + [layer.as_json() for layer in system_layers(order)],
+        "maps": maps
+    }
+
+
+def write_snapshot():
+    '''
+    Writes the catalogue snapshot to STATIC_ROOT as layers.<hash>.json,
+    named by content so it can be served with long lived caching, and
+    records it as current. Returns the file name, or None if there is no
+    snapshot for the old ordering.
+    '''
+    catalogue = snapshot()
+    pointer = os.path.join(settings.STATIC_ROOT, SNAPSHOT_POINTER)
+    if catalogue is None:
+        if os.path.exists(pointer):
+            os.remove(pointer)
+        cache.delete(SNAPSHOT_KEY)
+        return None
+    content = dumps(catalogue, sort_keys=True).encode("utf-8")
+    name = "layers.{0}.json".format(hashlib.sha1(content).hexdigest()[:12])
+    path = os.path.join(settings.STATIC_ROOT, name)
+    if not os.path.exists(path):
+        _write(path, content)
+    if snapshot_name() != name:
+        _write(pointer, name.encode("utf-8"))
+    cache.set(SNAPSHOT_KEY, name, None)
+    # drop superseded snapshots once pages can no longer be loading them
+    for other in os.listdir(settings.STATIC_ROOT):
+        otherpath = os.path.join(settings.STATIC_ROOT, other)
+        if SNAPSHOT_PATTERN.match(other) and other != name and os.path.getmtime(otherpath) < time.time() - SNAPSHOT_KEEP:
+            os.remove(otherpath)
+    return name
+
+
+def snapshot_changed(since):
+    '''
+    True if the catalogue may have changed at or after since (seconds since
+    the epoch, None for never built): a layer or map was saved, or
+    layerorder.json was replaced.
+    '''
+    if since is None:
+        return True
+    for name in (CATALOGUE_MARKER, "layerorder.json"):
+        try:
+            if os.path.getmtime(os.path.join(settings.STATIC_ROOT, name)) >= since:
+                return True
+        except OSError:
+            pass
+    return False
+
+
+def _write(path, content):
+    # write then rename so the static server never sees a partial file
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, "wb") as output:
+        output.write(content)
+    os.chmod(temp, 0o644)
+    os.rename(temp, path)
+
+
+def snapshot_name():
+    '''
+    File name of the current snapshot from the pointer file, or None
+    '''
+    try:
+        with open(os.path.join(settings.STATIC_ROOT, SNAPSHOT_POINTER)) as pointer:
+            return pointer.read().strip()
+    except IOError:
+        return None
+
+
+def snapshot_url():
+    '''
+    STATIC_URL of the current catalogue snapshot, or None if there isn't one
+    '''
+    name = cache.get(SNAPSHOT_KEY)
+    if name is None:
+        name = snapshot_name()
+        if name is None:
+            return None
+        cache.set(SNAPSHOT_KEY, name, None)
+    return settings.STATIC_URL + name
@@ -0,0 +1,188 @@
+'''
+Local store of logged tracking points, so repeat history queries for the
+same window don't go back to the SSS loggedpoint API.
+
+Points are kept per device in one file per UTC day, as zlib compressed
+JSON columns sorted by time. Each partition also records which spans of
+the day have been fetched from SSS, so a range query only goes upstream
+for the gaps and the rest is a bisect over the stored time column.
+Days older than HISTORY_KEEP are removed as the store is used.
+'''
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import time
+import zlib
+import shutil
+import bisect
+import calendar
+import tempfile
+from datetime import datetime
+
+from django.conf import settings
+
+HISTORY_ROOT = getattr(settings, "HISTORY_ROOT", os.path.join(tempfile.gettempdir(), "firesource_history"))
+# seconds back from now that SSS may still receive late points for, spans
+# newer than this are returned but not marked as stored
+HISTORY_SETTLE = 3600
+# days of history kept, checked every HISTORY_TRIM seconds
+HISTORY_KEEP = getattr(settings, "HISTORY_KEEP", 90)
+HISTORY_TRIM = 3600
+# SSS seen timestamps are local (AWST), the query window is UTC
+SEEN_OFFSET = 8 * 3600
+DAY = 86400
+
+
+def parse_date(value):
+    '''
+    UTC seconds since the epoch for a from_date/to_date string
+    '''
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError("unrecognised date: {0}".format(value))
+
+def format_date(seconds):
+    return datetime.utcfromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+def seen_utc(seen):
+    '''
+    UTC seconds since the epoch for a SSS seen timestamp
+    '''
+    return calendar.timegm((int(seen[:4]), int(seen[5:7]), int(seen[8:10]),
+        int(seen[11:13]), int(seen[14:16]), int(seen[17:19]))) - SEEN_OFFSET
+
+def subtract(span, covered):
+    '''
+    Parts of the half open span (start, end) not inside any covered span
+    '''
+    start, end = span
+    gaps = []
+    for low, high in sorted(covered):
+        if high <= start or low >= end:
+            continue
+        if low > start:
+            gaps.append((start, low))
+        start = max(start, high)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+def union(spans):
+    merged = []
+    for low, high in sorted(spans):
+        if merged and low <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    return merged
+
+
+class HistoryStore(object):
+    '''
+    Day partitioned point store under root, laid out as
+    root/<YYYY-MM-DD>/<device>.z
+    '''
+    def __init__(self, root, keep=HISTORY_KEEP):
+        self.root = root
+        self.keep = keep
+        self.trimmed = 0
+
+    def path(self, device, day):
+        return os.path.join(self.root, datetime.utcfromtimestamp(day * DAY).strftime("%Y-%m-%d"), "{0}.z".format(device))
+
+    def load(self, device, day):
+        try:
+            with open(self.path(device, day), "rb") as partition:
+                data = json.loads(zlib.decompress(partition.read()))
+        except (IOError, ValueError, zlib.error):
+            return {"covered": [], "time": [], "columns": {}}
+        return data
+
+    def save(self, device, day, data):
+        path = self.path(device, day)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        # write then rename so readers never see a partial partition
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, "wb") as partition:
+            partition.write(zlib.compress(json.dumps(data, separators=(",", ":"))))
+        os.rename(temp, path)
+
+    def rows(self, data, start=None, end=None):
+        '''
+        Points of a partition between start and end as dicts
+        '''
+        times = data["time"]
+        low = 0 if start is None else bisect.bisect_left(times, start)
+        high = len(times) if end is None else bisect.bisect_left(times, end)
+        columns = data["columns"].items()
+        return [dict((key, values[i]) for key, values in columns) for i in range(low, high)]
+
+    def merge(self, data, points, covered):
+        '''
+        Add points and covered spans to a partition, points are deduplicated
+        on their SSS id and kept in time order.
+        '''
+        rows = dict((row.get("id", (when, row.get("seen"))), (when, row))
+            for when, row in zip(data["time"], self.rows(data)))
+        for when, point in points:
+            rows[point.get("id", (when, point.get("seen")))] = (when, point)
+        ordered = sorted(rows.values(), key=lambda row: row[0])
+        keys = set()
+        for when, row in ordered:
+            keys.update(row)
+        data["time"] = [when for when, row in ordered]
+        data["columns"] = dict((key, [row.get(key) for when, row in ordered]) for key in keys)
+        data["covered"] = union(data["covered"] + covered)
+        return data
+
+    def points(self, device, start, end, fetch):
+        '''
+        Yields lists of logged points for device between start and end (UTC
+        seconds, inclusive) one day at a time, each day is loaded and its
+        gaps filled only once the one before has been consumed. fetch(start,
+        end) is called for spans not yet stored and should return an
+        iterable of lists of points from SSS.
+        '''
+        if time.time() - self.trimmed > HISTORY_TRIM:
+            self.trim()
+        end += 1
+        for day in range(start // DAY, (end - 1) // DAY + 1):
+            partition = self.load(device, day)
+            span = (max(start, day * DAY), min(end, (day + 1) * DAY))
+            settled = int(time.time()) - HISTORY_SETTLE
+            for low, high in subtract(span, partition["covered"]):
+                fetched = []
+                for page in fetch(low, high - 1):
+                    for point in page:
+                        when = seen_utc(point["seen"])
+                        if when // DAY == day:
+                            fetched.append((when, point))
+                covered = subtract((low, min(high, settled)), [])
+                if fetched or covered:
+                    self.merge(partition, fetched, covered)
+                    self.save(device, day, partition)
+            yield self.rows(partition, start, end)
+
+    def trim(self):
+        '''
+        Removes the days older than keep days
+        '''
+        self.trimmed = time.time()
+        oldest = datetime.utcfromtimestamp(self.trimmed - self.keep * DAY).strftime("%Y-%m-%d")
+        try:
+            days = os.listdir(self.root)
+        except OSError:
+            return
+        for day in days:
+            # day directories sort by date as strings
+            if len(day) == 10 and day < oldest:
+                shutil.rmtree(os.path.join(self.root, day), ignore_errors=True)
+
+history_store = HistoryStore(HISTORY_ROOT)
@@ -0,0 +1,49 @@
+from __future__ import print_function
+import json
+import random
+import timeit
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+
+from spatial.remote_devices import makefeatures, dumpfeatures
+
+
+def sample_devices(rows):
+    '''
+    Synthetic SSS device rows spread over the past week
+    '''
+    now = datetime.now()
+    devices = []
+    for i in range(rows):
+        seen = now - timedelta(seconds=random.randint(0, 10080 * 60))
+        devices.append({
+            "id": i,
+            "deviceid": unicode(300034012174320 + i),
+            "point": "POINT ({0!r} {1!r})".format(random.uniform(112, 129), random.uniform(-35, -14)),
+            "seen": seen.strftime("%Y-%m-%dT%H:%M:%S"),
+            "registration": "1QGA{0:03d}".format(i % 1000),
+            "altitude": random.randint(0, 500),
+            "heading": random.randint(0, 359),
+            "icon": "sss-2_wheel_drive",
+            "rin_display": "LT{0}".format(i % 100),
+            "velocity": random.choice([0, 12.5, 80])
+        })
+    return devices
+
+
+class Command(BaseCommand):
+    args = "[rows ...]"
+    help = "Compares json.dumps(makefeatures()) with dumpfeatures() for device GeoJSON"
+
+    def handle(self, *args, **options):
+        for rows in [int(arg) for arg in args] or [1000, 10000, 100000]:
+            devices = sample_devices(rows)
+            now = datetime.now()
+            if json.dumps(makefeatures(devices, now)) != dumpfeatures(devices, now):
+                print("{0} rows: output differs".format(rows))
+                continue
+            repeat = max(1, 100000 // rows)
+            old = min(timeit.repeat(lambda: json.dumps(makefeatures(devices)), number=1, repeat=repeat))
+            new = min(timeit.repeat(lambda: dumpfeatures(devices), number=1, repeat=repeat))
+            print("{0} rows: makefeatures {1:.3f}s, dumpfeatures {2:.3f}s ({3:.1f}x)".format(rows, old, new, old / new))
@@ -0,0 +1,96 @@
+from __future__ import print_function
+import json
+import random
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.query import QuerySet
+
+from messaging.models import JSON_BACKENDS, maybe_call
+from spatial.catalogue import TRACKING_LAYERS
+
+
+class ProbingEncoder(DjangoJSONEncoder):
+    '''
+    JSONEncoder as it was, probing every object for as_dict/as_list
+    '''
+    def default(self, obj):
+        if hasattr(obj, 'as_dict'):
+            return maybe_call(obj.as_dict)
+        elif hasattr(obj, 'as_list'):
+            return maybe_call(obj.as_list)
+        elif isinstance(obj, QuerySet):
+            return list(obj)
+        return super(ProbingEncoder, self).default(obj)
+
+
+class Version(object):
+    def __init__(self, layer_id):
+        self.layer_id = layer_id
+
+    def as_dict(self):
+        return repr([None, self.layer_id])
+
+
+def sample_catalogue(layers):
+    '''
+    Synthetic layers.json payload, RasterLayer.as_json shaped layers with
+    datetimes, Decimals and as_dict objects mixed in, and some maps
+    '''
+    now = datetime.utcnow()
+    catalogue = {"layers": list(TRACKING_LAYERS), "maps": []}
+    for i in range(layers):
+        layer_id = "layer_{0}".format(i)
+        catalogue["layers"].append({
+            "id": layer_id,
+            "name": "Layer {0}".format(i),
+            "details": {
+                "updated": now - timedelta(days=random.randint(0, 1000)),
+                "tags": ["fire", "history", layer_id],
+                "custodian": "DPAW",
+                "legend_width": 400,
+                "opacity": Decimal("0.{0}".format(random.randint(1, 99)))
+            },
+            "tags": "fire, history, default",
+            "type": random.choice(["point", "line", "polygon", "overlay", "imagery"]),
+            "url": "//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms",
+            "legend": "//static.dpaw.wa.gov.au/static/firesource/static/source/legends/blank.png",
+            "layers": "dpaw:" + layer_id,
+            "transition_effect": "resize",
+            "tiled": True,
+            "transparent": True,
+            "version": Version(layer_id)
+        })
+    for i in range(layers // 10):
+        catalogue["maps"].append({
+            "name": "Map {0}".format(i),
+            "layers": [{"layer_id": "layer_{0}".format(j), "opacity": 1} for j in range(10)],
+            "immutable": True,
+            "center": {"type": "Point", "coordinates": [random.uniform(112, 129), random.uniform(-35, -14)]},
+            "scale": 50000,
+            "date_modified": now
+        })
+    return catalogue
+
+
+class Command(BaseCommand):
+    args = "[layers ...]"
+    help = "Compares the JSONEncoder backends on a synthetic layer catalogue"
+
+    def handle(self, *args, **options):
+        backends = [("json (probing)", lambda obj: json.dumps(obj, cls=ProbingEncoder))] + JSON_BACKENDS
+        for layers in [int(arg) for arg in args] or [100, 1000, 10000]:
+            catalogue = sample_catalogue(layers)
+            expected = json.loads(backends[0][1](catalogue))
+            repeat = max(3, 10000 // layers)
+            baseline = None
+            for name, dumps in backends:
+                if json.loads(dumps(catalogue)) != expected:
+                    print("{0} layers: {1} output differs".format(layers, name))
+                    continue
+                seconds = min(timeit.repeat(lambda: dumps(catalogue), number=1, repeat=repeat))
+                baseline = baseline or seconds
+                print("{0} layers: {1} {2:.4f}s ({3:.1f}x)".format(layers, name, seconds, baseline / seconds))
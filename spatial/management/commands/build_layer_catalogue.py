@@ -0,0 +1,41 @@
+from __future__ import print_function
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from spatial.catalogue import snapshot_changed, write_snapshot
+
+
+class Command(BaseCommand):
+    help = "Writes the layer catalogue snapshot (layers.<hash>.json) to STATIC_ROOT"
+    option_list = BaseCommand.option_list + (
+        make_option("--watch", type="int", dest="watch", default=0, metavar="SECONDS",
+            help="Keep running, checking every SECONDS for saved layers or maps and rebuilding the snapshot after them"),
+    )
+
+    def handle(self, *args, **options):
+        built = self.build()
+        while options["watch"]:
+            time.sleep(options["watch"])
+            if snapshot_changed(built):
+                built = self.build()
+
+    def build(self):
+        '''
+        Writes the snapshot, returns the time the build started or None if
+        it failed
+        '''
+        started = time.time()
+        try:
+            name = write_snapshot()
+        except (IOError, OSError) as e:
+            # an unwritable STATIC_ROOT leaves the old snapshot (or layers.json) in use
+            print("Couldn't write the catalogue snapshot: {0}".format(e), file=sys.stderr)
+            return None
+        if name:
+            print("Wrote {0}".format(name))
+        else:
+            print("No layerorder.json, the catalogue is built per user")
+        return started
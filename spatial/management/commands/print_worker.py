@@ -0,0 +1,24 @@
+from __future__ import print_function
+import signal
+
+from django.core.management.base import BaseCommand
+
+from spatial.printing import PRINT_WORKERS, start_workers
+
+
+class Command(BaseCommand):
+    args = "[workers]"
+    help = "Runs a pool of print workers rendering queued print jobs (PRINT_WORKERS by default)"
+
+    def handle(self, *args, **options):
+        count = int(args[0]) if args else PRINT_WORKERS
+        workers = start_workers(count)
+        print("Started {0} print workers".format(count))
+
+        def stop(signum, frame):
+            for worker in workers:
+                worker.terminate()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,141 @@
+import hashlib
+from datetime import timedelta
+from optparse import make_option
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Case, When, Value, DateTimeField
+
+from messaging.models import Audit, bump_audit_version, versions_changed
+
+BATCH = 500
+
+DUPLICATES_SQL = """
+SELECT {id}, duplicate FROM (
+    SELECT {id}, {effective_from},
+        row_number() OVER (PARTITION BY {key}, {effective_from} ORDER BY {id}) - 1 AS duplicate
+    FROM {table}) versions
+WHERE duplicate > 0
+"""
+
+OVERLAPS_SQL = """
+SELECT {id}, {key}, {effective_from}, {effective_to}, next_from FROM (
+    SELECT {id}, {key}, {effective_from}, {effective_to},
+        lead({effective_from}) OVER (PARTITION BY {key} ORDER BY {effective_from}, {id}) AS next_from
+    FROM {table}) versions
+WHERE (next_from IS NOT NULL AND ({effective_to} IS NULL OR {effective_to} > next_from))
+    OR {effective_to} < {effective_from}
+"""
+
+
+def model_label(model):
+    return "{0}.{1}".format(model._meta.app_label, model._meta.object_name)
+
+
+def versioned_models(labels):
+    '''
+    The concrete models holding effective_from/effective_to for the given
+    app_label.Model labels, or for every Audit model
+    '''
+    if labels:
+        try:
+            candidates = [apps.get_model(label) for label in labels]
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+    else:
+        candidates = [model for model in apps.get_models() if issubclass(model, Audit)]
+    models = []
+    for model in candidates:
+        if not issubclass(model, Audit):
+            raise CommandError("{0} is not an Audit model".format(model_label(model)))
+        # multi table children are repaired through their parent
+        model = model._meta.get_field("effective_to").model
+        if model not in models:
+            models.append(model)
+    return models
+
+
+def natural_key_columns(model):
+    '''
+    Columns of the natural key, from the unique_together with effective_to
+    '''
+    for fields in model._meta.unique_together:
+        if "effective_to" in fields:
+            return [model._meta.get_field(name).column for name in fields if name != "effective_to"]
+    raise CommandError("{0} has no unique_together with effective_to".format(model_label(model)))
+
+
+class Command(BaseCommand):
+    args = "[app_label.Model ...]"
+    help = ("Ends overlapping and multiple active versions of Audit models for all natural keys at once, "
+        "each version ends where the next one starts. Defaults to every Audit model.")
+    option_list = BaseCommand.option_list + (
+        make_option("--dry-run", action="store_true", dest="dry_run", default=False,
+            help="List the changes, making them in a transaction that is rolled back"),
+    )
+
+    def handle(self, *args, **options):
+        repaired = []
+        for model in versioned_models(args):
+            with transaction.atomic():
+                changed = self.repair(model, options["dry_run"])
+                if options["dry_run"]:
+                    transaction.set_rollback(True)
+                elif changed:
+                    repaired.append(model)
+        # caches over whole models (e.g. the layer catalogue) are dropped once
+        for model in repaired:
+            versions_changed.send(sender=model, instances=[])
+
+    def query(self, sql, model):
+        qn = connection.ops.quote_name
+        columns = dict((name, qn(model._meta.get_field(name).column)) for name in ("effective_from", "effective_to"))
+        columns.update({
+            "id": qn(model._meta.pk.column),
+            "key": ", ".join(qn(column) for column in natural_key_columns(model)),
+            "table": qn(model._meta.db_table)
+        })
+        cursor = connection.cursor()
+        cursor.execute(sql.format(**columns))
+        return cursor
+
+    def update(self, model, field, changes):
+        '''
+        Sets field to the value for each (pk, value), one UPDATE per batch
+        '''
+        for i in range(0, len(changes), BATCH):
+            batch = changes[i:i + BATCH]
+            value = Case(*[When(pk=pk, then=Value(v)) for pk, v in batch], output_field=DateTimeField())
+            model._base_manager.filter(pk__in=[pk for pk, v in batch]).update(**{field: value})
+
+    def repair(self, model, dry_run):
+        label = model_label(model)
+        # versions sharing an effective_from are nudged apart by a microsecond
+        # each, so the ordering below is the same every time
+        duplicates = list(self.query(DUPLICATES_SQL, model))
+        if duplicates:
+            starts = dict(model._base_manager.filter(pk__in=[pk for pk, n in duplicates]).values_list("pk", "effective_from"))
+            changes = [(pk, starts[pk] + timedelta(microseconds=n)) for pk, n in duplicates]
+            for pk, start in changes:
+                self.stdout.write("{0} {1}: effective_from {2} -> {3}".format(label, pk, starts[pk], start))
+            # made for a dry run too so the overlaps are found as they would be
+            self.update(model, "effective_from", changes)
+        changes = []
+        keys = set()
+        for row in self.query(OVERLAPS_SQL, model):
+            pk, key, start, end, next_start = row[0], row[1:-3], row[-3], row[-2], row[-1]
+            if next_start is not None and (end is None or end > next_start):
+                fixed = next_start
+            else:
+                fixed = start
+            self.stdout.write("{0} {1} {2}: effective_to {3} -> {4}".format(label, pk, list(key), end, fixed))
+            changes.append((pk, fixed))
+            keys.add(tuple(key))
+        self.update(model, "effective_to", changes)
+        self.stdout.write("{0}: {1} versions of {2} keys {3}".format(label, len(changes) + len(duplicates), len(keys),
+            "to repair" if dry_run else "repaired"))
+        if not dry_run:
+            for key in keys:
+                bump_audit_version(hashlib.sha1(repr(list(key))).hexdigest())
+        return bool(changes or duplicates)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import messaging.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spatial', '0003_auto_20151107_2100'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='layer',
+            name='details',
+            field=messaging.models.LazyJSONField(),
+        ),
+        migrations.AlterField(
+            model_name='map',
+            name='layers',
+            field=messaging.models.LazyJSONField(),
+        ),
+        migrations.AlterField(
+            model_name='map',
+            name='completed_files',
+            field=messaging.models.LazyJSONField(null=True, blank=True),
+        ),
+    ]
@@ -25,10 +25,12 @@ from datetime import datetime
 import re
 import os
 
+from django.conf import settings
 from django.contrib.gis import geos, admin
 from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete
 
-from messaging.models import models, Audit, AuditManager, JSONField, json
+from messaging.models import models, Audit, AuditManager, LazyJSONField, json, versions_changed, cache_version, bump_cache_version
 
 class MapManager(AuditManager):
     '''
@@ -47,14 +49,14 @@ class Map(Audit):
     '''
     map_id = models.CharField(max_length=320)
     name = models.CharField(max_length=320)
-    layers = JSONField()
+    layers = LazyJSONField()
     bounds = models.PolygonField(srid = 4283, null=True, blank=True, editable=False)
     center = models.PointField(srid = 4283, default="POINT (0 0)", editable=False)
     zoom = models.FloatField(default=0)
     scale = models.IntegerField(default=50000)
     immutable = models.BooleanField(default=True)
     workdir = models.CharField(max_length=320, null=True, blank=True)
-    completed_files = JSONField(null=True, blank=True)
+    completed_files = LazyJSONField(null=True, blank=True)
     map_type = models.CharField(
         max_length=16, default="map",
         choices=(("map","map"), ("theme","theme")))
@@ -139,7 +141,7 @@ class Layer(Audit):
     layer_id = models.CharField(max_length=320)
     name = models.CharField(max_length=320)
     legend = models.CharField(max_length=320, default="https://static.dpaw.wa.gov.au/static/firesource/static/source/legends/blank.png")
-    details = JSONField()
+    details = LazyJSONField()
     shown = models.BooleanField(default=False)
     immutable = models.BooleanField(default=True)
 
@@ -233,3 +235,38 @@ class RasterLayerAdmin(admin.ModelAdmin):
     list_editable = ('layer_type', 'tiled', 'transparent', 'transition_effect')
 
 admin.site.register(RasterLayer, RasterLayerAdmin)
+
+
+CATALOGUE_VERSION = "layercatalogue.version"
+
+def catalogue_version():
+    '''
+    cache_version of the layer catalogue (layers and maps), cached
+    catalogues are keyed on it
+    '''
+    return cache_version(CATALOGUE_VERSION)
+
+def bump_catalogue_version(sender, **kwargs):
+    bump_cache_version(CATALOGUE_VERSION)
+
+# file in STATIC_ROOT touched on every catalogue change, build_layer_catalogue
+# --watch rebuilds the snapshot once it is newer than the last build
+CATALOGUE_MARKER = "layers.changed"
+
+def touch_catalogue_marker(sender, **kwargs):
+    '''
+    Marks the catalogue snapshot out of date. Only touches a file so saves
+    stay cheap, and a STATIC_ROOT that can't be written doesn't fail them.
+    '''
+    path = os.path.join(settings.STATIC_ROOT, CATALOGUE_MARKER)
+    try:
+        with open(path, "a"):
+            os.utime(path, None)
+    except (IOError, OSError):
+        pass
+
+for model in (Map, Layer, RasterLayer):
+    for receiver, name in ((bump_catalogue_version, "catalogue_version"), (touch_catalogue_marker, "catalogue_marker")):
+        post_save.connect(receiver, sender=model, dispatch_uid=name + "_save_" + model.__name__)
+        post_delete.connect(receiver, sender=model, dispatch_uid=name + "_delete_" + model.__name__)
+        versions_changed.connect(receiver, sender=model, dispatch_uid=name + "_bulk_" + model.__name__)
@@ -0,0 +1,699 @@
+'''
+Map printing: renders a map state to PDF or JPG from GDAL WMS images of
+each layer and an Inkscape template.
+
+Prints are either rendered inside the request by the print view, or
+queued as print jobs in a local SQLite database and rendered by a
+bounded pool of worker processes (manage.py print_worker), so a long A3
+print doesn't hold a uwsgi worker.
+'''
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import os
+import json
+import math
+import hashlib
+import time
+import uuid
+import shutil
+import signal
+import sqlite3
+import calendar
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from geopy import distance
+
+try:
+    import numpy
+    from osgeo import gdal
+    gdal.UseExceptions()
+except ImportError:
+    numpy = gdal = None
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.shortcuts import render_to_response
+
+from spatial.models import Map, RasterLayer
+from spatial.utils import logger_setup
+
+GDAL_TRANSLATE = os.path.join(settings.GDAL_APPS, "gdal_translate")
+PRINT_ROOT = getattr(settings, "PRINT_ROOT", os.path.join(tempfile.gettempdir(), "firesource_print"))
+PRINT_WORKERS = getattr(settings, "PRINT_WORKERS", 2)
+# rendered prints by content, reused for PRINT_RESULTS_AGE seconds
+PRINT_RESULTS = getattr(settings, "PRINT_RESULTS", os.path.join(PRINT_ROOT, "results"))
+PRINT_RESULTS_SIZE = getattr(settings, "PRINT_RESULTS_SIZE", 1024 ** 3)
+PRINT_RESULTS_AGE = 600
+# seconds finished jobs are kept, and a job may run for
+PRINT_KEEP = 86400
+PRINT_TIMEOUT = 1800
+# seconds an idle worker waits between looking for jobs
+PRINT_POLL = 1
+WORKDIR_ROOT = "/run/shm"
+# layers fetched from WMS at once for a print, and seconds each may take
+PRINT_LAYER_CONCURRENCY = getattr(settings, "PRINT_LAYER_CONCURRENCY", 4)
+PRINT_LAYER_TIMEOUT = 300
+# seconds GDAL waits on a single WMS request
+PRINT_TILE_TIMEOUT = 60
+# WMS tiles cached on disk across prints, per WMS user as they are fetched
+# with their credentials, trimmed to PRINT_TILE_CACHE_SIZE bytes (least
+# recently used first) every PRINT_TILE_TRIM seconds
+PRINT_TILE_CACHE = getattr(settings, "PRINT_TILE_CACHE", os.path.join(PRINT_ROOT, "tiles"))
+PRINT_TILE_CACHE_SIZE = getattr(settings, "PRINT_TILE_CACHE_SIZE", 2 * 1024 ** 3)
+PRINT_TILE_TRIM = 300
+# seconds a cached tile is used for, like PRINT_RESULTS_AGE, GDAL before 2.3
+# ignores <Expires> so older tiles are also removed by trim_tile_cache
+PRINT_TILE_EXPIRES = 600
+# layers never read through the tile cache (layer_id prefixes), they change
+# by the minute
+PRINT_LIVE_LAYERS = getattr(settings, "PRINT_LIVE_LAYERS", ("resource_tracking",))
+# WMS requests GDAL makes at once for one layer, a cold cache means a
+# request per TILE_SIZE block
+PRINT_TILE_CONNECTIONS = getattr(settings, "PRINT_TILE_CONNECTIONS", 8)
+TILE_SIZE = 256
+# layers are composited in process when GDAL and NumPy are installed,
+# otherwise each is written out by gdal_translate and convert for Inkscape
+PRINT_COMPOSITE = getattr(settings, "PRINT_COMPOSITE", True) and gdal is not None
+
+# set up once, print_worker processes run for good and each logger_setup
+# would otherwise open another log file
+tile_logger = logger_setup('tile_wms')
+print_logger = logger_setup('print')
+
+# sizes in mm: x, y
+document_sizes = {
+    "inkscape_a3_portrait": (272, 352),
+    "inkscape_a3_landscape": (391, 232)
+}
+
+MIMETYPES = {
+    "pdf": "application/pdf",
+    "jpg": "image/jpg"
+}
+
+
+class PrintError(Exception):
+    '''
+    A print that failed in a way the user can do something about, the
+    message is html for the response.
+    '''
+    pass
+
+
+def centerscale_topoly(center, scale, docsize):
+    '''
+    Takes a document size and center and scale, and generates a bounding box
+    for that scale and document size as a polygon in Well Known Text
+    '''
+    # calculate bounds from center and set them according to template
+    if not isinstance(center, distance.Point):
+        try:
+            center = distance.Point(longitude=center.x,latitude=center.y)
+        except:
+            center = distance.Point(center)
+    width = distance.distance(meters = docsize[0] / 1000 * scale)
+    midleft = (width * 0.5).destination(center, 270)
+    topleft = distance.Point(longitude=midleft.longitude, latitude = center.latitude + (midleft.longitude - center.longitude) * (docsize[1]/docsize[0]))
+    bottomright = distance.Point(longitude=center.longitude + (center.longitude - midleft.longitude), latitude = center.latitude - (topleft.latitude - center.latitude))
+    return "POLYGON (({0.longitude} {0.latitude}, {1.longitude} {0.latitude}, {1.longitude} {1.latitude}, {0.longitude} {1.latitude}, {0.longitude} {0.latitude}))".format(topleft, bottomright)
+
+def wms_xml(layer, extent, docsize, dpi, workdir, wmsauth):
+    '''
+    Writes the GDAL_WMS description of layer for the extent and template
+    size to the current dir, returns its file name and the print size in
+    pixels
+    '''
+    logger = tile_logger
+    logger.info('Called with: {0}'.format((layer, extent, docsize, dpi, workdir)))
+    sizex = docsize[0] / 25.4 * dpi
+    sizey = sizex * (extent[3] - extent[1]) / (extent[2] - extent[0])
+    layerurl = "http:" + layer.url.replace("gwc/service/wms", "ows")
+    logger.info('layerurl: {0}'.format(layerurl))
+    # the layer is read through a whole world grid of TILE_SIZE blocks at
+    # the zoom just finer than the print, so tiles line up between prints
+    # and GDAL can cache them, then cut down to the print extent
+    zoom = tile_zoom(extent, sizex)
+    gridx, gridy = 2 * TILE_SIZE * 2 ** zoom, TILE_SIZE * 2 ** zoom
+    tilesize, timeout, connections = TILE_SIZE, PRINT_TILE_TIMEOUT, PRINT_TILE_CONNECTIONS
+    if layer.layer_id.startswith(tuple(PRINT_LIVE_LAYERS)):
+        tilecache = None
+    else:
+        tilecache, expires = tile_cache_path(wmsauth), PRINT_TILE_EXPIRES
+    gdaltile = render_to_response('spatial/gdalwms.xml', locals())
+    logger.info('gdaltile:')
+    logger.info(gdaltile.content)
+    with open(layer.layer_id + ".xml", "w") as gdalfile:
+        gdalfile.write(gdaltile.content)
+    return layer.layer_id + ".xml", (int(round(sizex)), int(round(sizey)))
+
+def wms_command(layer, extent, docsize, dpi, workdir, wmsauth):
+    '''
+    The shell command rendering layer to an image in the current dir, and
+    the image it writes
+    '''
+    if layer.transparent:
+        layerimage, outputformat = layer.layer_id + ".png", "PNG"
+    else:
+        layerimage, outputformat = layer.layer_id + ".jpg", "JPEG"
+    gdalxml, size = wms_xml(layer, extent, docsize, dpi, workdir, wmsauth)
+    window = "-projwin {0!r} {1!r} {2!r} {3!r} -outsize {4} {5} -r bilinear".format(extent[0], extent[3], extent[2], extent[1], size[0], size[1])
+    return "gdal_translate -q -of {0} {3} {1} {2} && convert {2} -transparent white {2}".format(outputformat, gdalxml, layerimage, window), layerimage
+
+def layer_bands(bands, transparent):
+    '''
+    (rgb, alpha) arrays of a layer from ReadAsArray, grey layers (one band,
+    or two with alpha) are expanded to rgb. White is keyed out of
+    transparent layers as convert -transparent white did.
+    '''
+    if bands.ndim == 2:
+        bands = bands[numpy.newaxis]
+    colours = 3 if len(bands) >= 3 else 1
+    rgb = bands[:3] if colours == 3 else numpy.repeat(bands[:1], 3, axis=0)
+    opaque = numpy.full(rgb.shape[1:], 255, numpy.uint8)
+    if not transparent:
+        return rgb, opaque
+    alpha = bands[colours] if len(bands) > colours else opaque
+    return rgb, numpy.where((rgb == 255).all(axis=0), 0, alpha)
+
+def read_layer(layer, extent, docsize, dpi, workdir, wmsauth, timeout=None):
+    '''
+    Reads layer for the print straight into memory as (rgb, alpha) arrays,
+    see layer_bands. The read is abandoned once it has taken timeout
+    seconds.
+    '''
+    deadline = None if timeout is None else time.time() + timeout
+    gdalxml, size = wms_xml(layer, extent, docsize, dpi, workdir, wmsauth)
+    # GDAL calls this as the read progresses and stops when it returns 0,
+    # each WMS request is limited by PRINT_TILE_TIMEOUT in the xml
+    progress = lambda complete, message, data: int(deadline is None or time.time() < deadline)
+    dataset = gdal.Translate("", gdalxml, format="MEM", projWin=[extent[0], extent[3], extent[2], extent[1]],
+        width=size[0], height=size[1], resampleAlg="bilinear", callback=progress)
+    if dataset is None:
+        if deadline is not None and time.time() >= deadline:
+            raise RuntimeError("timed out after {0} seconds".format(timeout))
+        raise RuntimeError(gdal.GetLastErrorMsg() or "couldn't read {0}".format(gdalxml))
+    return layer_bands(dataset.ReadAsArray(), layer.transparent)
+
+def read_layers(layers, extent, docsize, dpi, workdir, wmsauth, limit=PRINT_LAYER_CONCURRENCY, timeout=PRINT_LAYER_TIMEOUT):
+    '''
+    read_layer for each of layers on limit threads (GDAL releases the GIL
+    while it fetches), each given timeout seconds from when it starts.
+    Returns the arrays or the exception for each layer in the order given.
+    '''
+    # the xml files are written here, the current dir is per process, so
+    # layers listed twice are read once rather than sharing an xml file
+    unique = []
+    for layer in layers:
+        if layer.layer_id not in [other.layer_id for other in unique]:
+            unique.append(layer)
+    # a layer's own timeout is checked between blocks, this is a backstop
+    # for a read stuck in a single WMS request
+    rounds = (len(unique) + limit - 1) // limit
+    deadline = time.time() + rounds * (timeout + PRINT_TILE_TIMEOUT)
+    pool = ThreadPool(limit)
+    results = {}
+    try:
+        pending = [(layer.layer_id, pool.apply_async(read_layer, (layer, extent, docsize, dpi, workdir, wmsauth, timeout)))
+            for layer in unique]
+        for layer_id, result in pending:
+            try:
+                results[layer_id] = result.get(max(0, deadline - time.time()))
+            except TimeoutError:
+                results[layer_id] = RuntimeError("timed out after {0} seconds".format(timeout))
+            except Exception as e:
+                results[layer_id] = e
+    finally:
+        pool.terminate()
+    return [results[layer.layer_id] for layer in layers]
+
+def composite(stack, path):
+    '''
+    Alpha composites the (rgb, alpha) "location" of each layer in stack,
+    bottom first, over white with the layers opacity and writes the result
+    to path as an RGB PNG
+    '''
+    rgb = stack[0]["location"][0]
+    output = numpy.full(rgb.shape, 255, numpy.float32)
+    for lyr in stack:
+        rgb, alpha = lyr["location"]
+        opacity = 1 if lyr.get("opacity") in (None, "") else float(lyr["opacity"])
+        output += (rgb - output) * (alpha * (opacity / 255))
+    output = output.round().astype(numpy.uint8)
+    image = gdal.GetDriverByName("MEM").Create("", output.shape[2], output.shape[1], 3, gdal.GDT_Byte)
+    for band in range(3):
+        image.GetRasterBand(band + 1).WriteArray(output[band])
+    gdal.GetDriverByName("PNG").CreateCopy(path, image)
+
+def tile_zoom(extent, sizex):
+    '''
+    Zoom level of the world grid (two TILE_SIZE tiles across 180 degrees at
+    zoom 0) with pixels no larger than the prints
+    '''
+    resolution = (extent[2] - extent[0]) / sizex
+    return max(0, int(math.ceil(math.log(180 / TILE_SIZE / resolution, 2))))
+
+def tile_cache_path(wmsauth, root=PRINT_TILE_CACHE):
+    '''
+    Tile cache dir for the WMS user of wmsauth ("user:shared id"), so tiles
+    fetched with one users credentials never end up on anothers print
+    '''
+    user = wmsauth.split(":")[0]
+    return os.path.join(root, hashlib.sha1(user.encode("utf-8")).hexdigest()[:16])
+
+def trim_files(root, size, expires=None, keep=None):
+    '''
+    Removes the files under root written more than expires seconds ago,
+    then the least recently used (by access or modification time) until
+    they add up to at most size bytes, other than the file at keep however
+    large it is. Returns the bytes left.
+    '''
+    files, total = [], 0
+    expired = None if expires is None else time.time() - expires
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+                if expired is not None and stat.st_mtime < expired and path != keep:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+            total += stat.st_size
+    files.sort()
+    for used, filesize, path in files:
+        if total <= size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= filesize
+    return total
+
+def trim_tile_cache(root=PRINT_TILE_CACHE, size=PRINT_TILE_CACHE_SIZE, expires=PRINT_TILE_EXPIRES):
+    '''
+    Removes tiles fetched more than expires seconds ago, then the least
+    recently used tiles until the cache holds at most size bytes. Returns
+    the bytes left.
+    '''
+    return trim_files(root, size, expires)
+
+def tile_wms(layer, extent, docsize, dpi, workdir, wmsauth):
+    '''
+    takes a layer and generates a tiled wms of that layer in the current dir for the
+    specified extent and template size
+    '''
+    command, layerimage = wms_command(layer, extent, docsize, dpi, workdir, wmsauth)
+    subprocess.check_call(command, shell=True)
+    tile_logger.info("layerimage creation successful: {0}".format(layerimage))
+    return layerimage
+
+def tile_wms_layers(layers, extent, docsize, dpi, workdir, wmsauth, limit=PRINT_LAYER_CONCURRENCY, timeout=PRINT_LAYER_TIMEOUT):
+    '''
+    tile_wms for each of layers at once, at most limit running at a time
+    and each killed after timeout seconds. Returns the layer image or the
+    exception for each layer, in the order given.
+    '''
+    logger = tile_logger
+    results = {}
+    pending = []
+    for layer in layers:
+        # layers listed twice share their image
+        if layer.layer_id not in results:
+            results[layer.layer_id] = None
+            pending.append(layer)
+    pending.reverse()
+    running = {}
+    while pending or running:
+        while pending and len(running) < limit:
+            layer = pending.pop()
+            try:
+                command, layerimage = wms_command(layer, extent, docsize, dpi, workdir, wmsauth)
+            except Exception as e:
+                results[layer.layer_id] = e
+                continue
+            # own process group, so a timeout also kills the shell's children
+            process = subprocess.Popen(command, shell=True, preexec_fn=os.setsid)
+            running[layer.layer_id] = (process, command, layerimage, time.time())
+        time.sleep(0.1)
+        for layer_id, (process, command, layerimage, started) in running.items():
+            if process.poll() is not None:
+                if process.returncode == 0:
+                    logger.info("layerimage creation successful: {0}".format(layerimage))
+                    results[layer_id] = layerimage
+                else:
+                    results[layer_id] = subprocess.CalledProcessError(process.returncode, command)
+                del running[layer_id]
+            elif time.time() - started > timeout:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                results[layer_id] = RuntimeError("timed out after {0} seconds".format(timeout))
+                del running[layer_id]
+    return [results[layer.layer_id] for layer in layers]
+
+def print_map(state, name, user):
+    '''
+    Unsaved Map for a print of the map state (the ss parameter)
+    '''
+    spatialmap = Map(name=name, created_by=user, modified_by=user)
+    spatialmap.layers = state["layers"]
+    spatialmap.center = "POINT ({0} {1})".format(*state["center"]["coordinates"])
+    spatialmap.scale = int(state["scale"])
+    spatialmap.workdir = spatialmap.created_by.email + "-sssprint-" + spatialmap.date_created.strftime("%Y%m%d_%H%M")
+    spatialmap.template = "inkscape_a3_landscape"
+    return spatialmap
+
+def render_print(spatialmap, workdir, dpi, fmt, wmsauth):
+    '''
+    Renders spatialmap in workdir, which is the current directory, and
+    returns (path, mimetype, filename) of the output. Raises PrintError
+    if a layer fails to render.
+    '''
+    logger = print_logger
+    docsize = document_sizes[spatialmap.template]
+    spatialmap.bounds = centerscale_topoly(spatialmap.center, spatialmap.scale, docsize)
+    # find out projection for printing eastings/northings
+    srid = False
+    if spatialmap.center.x > 108 and spatialmap.center.x <= 114: srid = 28349
+    elif spatialmap.center.x > 114 and spatialmap.center.x <= 120: srid = 28350
+    elif spatialmap.center.x > 120 and spatialmap.center.x <= 126: srid = 28351
+    elif spatialmap.center.x > 126 and spatialmap.center.x <= 132: srid = 28352
+    elif spatialmap.center.x > 132 and spatialmap.center.x <= 138: srid = 28353
+    elif spatialmap.center.x > 138 and spatialmap.center.x <= 144: srid = 28354
+    elif spatialmap.center.x > 144 and spatialmap.center.x <= 150: srid = 28355
+    elif spatialmap.center.x > 150 and spatialmap.center.x <= 156: srid = 28356
+    class bnds: pass
+    bnds.xmin, bnds.ymin = round(spatialmap.bounds.extent[0], 5), round(spatialmap.bounds.extent[1], 5)
+    bnds.xmid, bnds.ymid = round(spatialmap.center.x, 5), round(spatialmap.center.y, 5)
+    bnds.xmax, bnds.ymax = round(spatialmap.bounds.extent[2], 5), round(spatialmap.bounds.extent[3], 5)
+    # pbnds is projected bounds
+    if srid:
+        class pbnds: pass
+        from django.contrib.gis.geos.point import Point
+        pbnds.xmin, pbnds.ymin = Point(bnds.xmin, bnds.ymin, srid=4283).transform(srid, clone=True)
+        pbnds.xmid, pbnds.ymid = Point(bnds.xmid, bnds.ymid, srid=4283).transform(srid, clone=True)
+        pbnds.xmax, pbnds.ymax = Point(bnds.xmax, bnds.ymax, srid=4283).transform(srid, clone=True)
+        pbnds.xmin, pbnds.ymin = int(round(pbnds.xmin, 0)), int(round(pbnds.ymin, 0))
+        pbnds.xmid, pbnds.ymid = int(round(pbnds.xmid, 0)), int(round(pbnds.ymid, 0))
+        pbnds.xmax, pbnds.ymax = int(round(pbnds.xmax, 0)), int(round(pbnds.ymax, 0))
+    # calculate this from scalebars/km given scalebar is 0.2m
+    scalebar_kms = round(spatialmap.scale / 5000, 2)
+    # this should asjust for users local time not servers local time. Users offset should be set automatically on map load by browsers offset.
+    spatialmap_datetime = datetime.fromtimestamp(time.mktime(time.localtime(calendar.timegm(spatialmap.date_created.timetuple())))).strftime("%a, %d %b %Y %H:%M")
+    composite = spatialmap.map_id + spatialmap.date_created.strftime("_%Y%m%d_%H%M")
+    compositepng = "{0}.png".format(composite)
+    compositejpg = "{0}.jpg".format(composite)
+    compositepdf = "{0}.pdf".format(composite)
+    logger.info("Starting to iterate through layers: {0}".format(spatialmap.layers))
+    printed = []
+    for index, lyr in enumerate(spatialmap.layers):
+        logger.info("Layer: {0}".format(lyr))
+        if not RasterLayer.objects.filter(url__startswith="//kmi.dpaw.wa.gov.au/", layer_id=lyr["layer_id"]).order_by("-effective_from").exists():
+            if lyr["layer_id"].startswith("resource_tracking_week_base"):
+                lyr["layer_id"] = "resource_tracking_printable"
+            else:
+                continue
+        layer = RasterLayer.objects.filter(layer_id=lyr["layer_id"]).order_by("-effective_from")[0]
+        logger.info("Layer {0} is a raster layer, call tile_wms".format(layer))
+        printed.append((lyr, layer))
+    render_layers = read_layers if PRINT_COMPOSITE else tile_wms_layers
+    images = render_layers([layer for lyr, layer in printed], extent=spatialmap.bounds.extent, docsize=docsize, dpi=dpi, workdir=workdir, wmsauth=wmsauth)
+    # layers keep their stacking order, the first failure is reported
+    for (lyr, layer), image in zip(printed, images):
+        if isinstance(image, Exception):
+            raise PrintError("<h2>Layer <u>{0}</u> failed to render, try zooming in or disabling this layer and printing again.</h2>workdir: <pre>{1}</pre><br>error: <pre>{2}</pre>".format(layer.name, workdir, image))
+        lyr["location"] = image
+    if PRINT_COMPOSITE:
+        # the template gets one flattened image under its vector furniture
+        stack = [lyr for lyr in spatialmap.print_layers if lyr.get("location") is not None]
+        if stack:
+            composite(stack, compositepng)
+            spatialmap.layers = [{"layer_id": "composite", "location": compositepng, "opacity": 1}]
+        else:
+            spatialmap.layers = []
+    finalpng = "inkscape_" + compositepng
+    finaljpg = "inkscape_" + compositejpg
+    finalsvg = finaljpg.replace(".jpg", ".svg")
+    finalpdf = "inkscape_" + compositepdf
+    with open(finalsvg, "w") as inkscapesvg:
+        inkscapesvg.write(render_to_response('spatial/{0}.svg'.format(spatialmap.template), locals()).content)
+    if fmt == "pdf":
+        subprocess.check_call("inkscape {0} --export-dpi={2} --export-pdf={1}".format(finalsvg, finalpdf, dpi), shell=True)
+        output = finalpdf
+    elif fmt == "jpg":
+        subprocess.check_call("inkscape {0} --export-dpi={2} --export-png={1} && convert {1} -quality 100% {3}".format(finalsvg, finalpng, dpi, finaljpg), shell=True)
+        output = finaljpg
+    return os.path.join(workdir, output), MIMETYPES[fmt], spatialmap.name + "." + fmt
+
+
+class PrintQueue(object):
+    '''
+    Print jobs in a SQLite database under root, shared by the web processes
+    that submit them and the workers that render them. A job's status goes
+    queued -> running -> done or failed.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, "jobs.sqlite3")
+        self.private = False
+
+    def connect(self):
+        if not self.private:
+            # params hold the users wms credentials until a job is rendered,
+            # so only the user running the site can read the database
+            try:
+                os.makedirs(self.root, 0o700)
+            except OSError:
+                pass
+            os.chmod(self.root, 0o700)
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            os.chmod(self.path, 0o600)
+            self.private = True
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, status TEXT, user INTEGER, params TEXT, submitted REAL, started REAL,
+            finished REAL, path TEXT, mimetype TEXT, filename TEXT, error TEXT)""")
+        return db
+
+    def submit(self, params):
+        job_id = uuid.uuid4().hex
+        db = self.connect()
+        try:
+            db.execute("INSERT INTO jobs (id, status, user, params, submitted) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, params["user"], json.dumps(params), time.time()))
+        finally:
+            db.close()
+        return job_id
+
+    def get(self, job_id):
+        db = self.connect()
+        try:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            db.close()
+        return None if row is None else dict(row)
+
+    def position(self, job):
+        '''
+        Number of queued jobs ahead of job
+        '''
+        db = self.connect()
+        try:
+            return db.execute("SELECT count(*) FROM jobs WHERE status = 'queued' AND submitted < ?", (job["submitted"],)).fetchone()[0]
+        finally:
+            db.close()
+
+    def claim(self):
+        '''
+        Marks the oldest queued job as running and returns it, or None
+        '''
+        db = self.connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY submitted LIMIT 1").fetchone()
+            job = None if row is None else dict(row)
+            if job is not None:
+                db.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), job["id"]))
+            db.execute("COMMIT")
+        finally:
+            db.close()
+        return job
+
+    def finish(self, job_id, path=None, mimetype=None, filename=None, error=None):
+        # params hold the users wms credentials, they aren't kept once rendered
+        db = self.connect()
+        try:
+            db.execute("UPDATE jobs SET status = ?, params = NULL, finished = ?, path = ?, mimetype = ?, filename = ?, error = ? WHERE id = ?",
+                ("failed" if error else "done", time.time(), path, mimetype, filename, error, job_id))
+        finally:
+            db.close()
+
+    def expire(self):
+        '''
+        Fails jobs that have been running too long and removes finished
+        jobs once they are older than PRINT_KEEP, their output belongs to
+        the print_results store
+        '''
+        now = time.time()
+        db = self.connect()
+        try:
+            db.execute("UPDATE jobs SET status = 'failed', params = NULL, finished = ?, error = 'Timed out' WHERE status = 'running' AND started < ?",
+                (now, now - PRINT_TIMEOUT))
+            db.execute("DELETE FROM jobs WHERE finished < ?", (now - PRINT_KEEP,))
+        finally:
+            db.close()
+
+print_queue = PrintQueue(PRINT_ROOT)
+
+
+def print_key(state, name, user, template, dpi, fmt):
+    '''
+    Hash of everything that ends up on a print, so the same map prints to
+    the same key however its ss parameter was serialised. The center is
+    rounded to 5 decimal places (about a metre), as printed.
+    '''
+    layers = [[lyr["layer_id"], None if lyr.get("opacity") in (None, "") else round(float(lyr["opacity"]), 3)]
+        for lyr in state["layers"]]
+    center = [round(float(value), 5) for value in state["center"]["coordinates"]]
+    canonical = json.dumps([template, int(state["scale"]), center, layers, int(dpi), fmt, name, user.email],
+        separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class PrintResults(object):
+    '''
+    Rendered prints on disk under root by print_key, trimmed to size bytes
+    least recently used first. Prints older than max_age seconds aren't
+    reused, as they show the time printed and live tracking layers, but
+    are kept for the print jobs pointing at them.
+    '''
+    def __init__(self, root, size, max_age):
+        self.root = root
+        self.size = size
+        self.max_age = max_age
+
+    def path(self, key, fmt):
+        return os.path.join(self.root, key[:2], "{0}.{1}".format(key, fmt))
+
+    def get(self, key, fmt):
+        '''
+        A fresh print for key opened for reading, or None. It is opened here
+        so a trim can't remove it before it has been sent.
+        '''
+        path = self.path(key, fmt)
+        try:
+            output = open(path, "rb")
+        except IOError:
+            return None
+        stat = os.fstat(output.fileno())
+        if stat.st_mtime < time.time() - self.max_age:
+            output.close()
+            return None
+        # access time is the lru order, modification time the print time
+        try:
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            pass
+        return output
+
+    def put(self, key, fmt, output):
+        '''
+        Moves the rendered file at output into the store, returns its path
+        '''
+        path = self.path(key, fmt)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        # copy then rename so readers never see a partial print
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.close(handle)
+        shutil.move(output, temp)
+        os.chmod(temp, 0o644)
+        os.rename(temp, path)
+        self.trim(keep=path)
+        return path
+
+    def trim(self, keep=None):
+        '''
+        Removes the least recently used prints until the store is within
+        size, other than keep (the print just added) however large it is
+        '''
+        trim_files(self.root, self.size, keep=keep)
+
+print_results = PrintResults(PRINT_RESULTS, PRINT_RESULTS_SIZE, PRINT_RESULTS_AGE)
+
+
+def run_job(job):
+    '''
+    Renders a claimed print job in its own workdir, unless print_results
+    already has it, and returns the stored output
+    '''
+    params = json.loads(job["params"])
+    fmt = params["fmt"]
+    spatialmap = print_map(params["state"], params["name"], User.objects.get(pk=params["user"]))
+    key = print_key(params["state"], spatialmap.name, spatialmap.created_by, spatialmap.template, params["dpi"], fmt)
+    result = print_results.get(key, fmt)
+    if result is not None:
+        result.close()
+        return result.name, MIMETYPES[fmt], spatialmap.name + "." + fmt
+    workdir = os.path.join(WORKDIR_ROOT, "sssprint-" + job["id"])
+    cwd = os.getcwd()
+    os.makedirs(workdir)
+    os.chdir(workdir)
+    try:
+        path, mimetype, filename = render_print(spatialmap, workdir, params["dpi"], fmt, params["wmsauth"])
+        result = print_results.put(key, fmt, path)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result, mimetype, filename
+
+def print_worker():
+    '''
+    Worker process loop, renders queued jobs one at a time
+    '''
+    logger = print_logger
+    # connections inherited from the parent can't be shared
+    connections.close_all()
+    trimmed = 0
+    while True:
+        print_queue.expire()
+        if time.time() - trimmed > PRINT_TILE_TRIM:
+            trim_tile_cache()
+            trimmed = time.time()
+        job = print_queue.claim()
+        if job is None:
+            time.sleep(PRINT_POLL)
+            continue
+        logger.info("Print job {0} started".format(job["id"]))
+        try:
+            path, mimetype, filename = run_job(job)
+        except PrintError as e:
+            print_queue.finish(job["id"], error=unicode(e))
+        except Exception as e:
+            logger.exception("Print job {0} failed".format(job["id"]))
+            print_queue.finish(job["id"], error="<h2>Print failed</h2><pre>{0!r}</pre>".format(e))
+        else:
+            print_queue.finish(job["id"], path, mimetype, filename)
+            logger.info("Print job {0} done: {1}".format(job["id"], path))
+        finally:
+            connections.close_all()
+
+def start_workers(count=PRINT_WORKERS):
+    workers = [multiprocessing.Process(target=print_worker, name="print_worker_{0}".format(i)) for i in range(count)]
+    # not daemonic, so workers can start processes of their own
+    for worker in workers:
+        worker.start()
+    return workers
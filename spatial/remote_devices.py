@@ -1,14 +1,59 @@
 import json
-from datetime import datetime, timedelta
+import math
+import time
+import Queue
+import threading
+from operator import itemgetter
+from datetime import date, datetime, timedelta
+from json.encoder import encode_basestring_ascii
 from settings import SSS_URL
 
+from django.core.cache import cache
 from dpaw_utils import requests
 
+from spatial.utils import logger_setup, cached_payload
+from spatial.history import history_store, parse_date, format_date, seen_utc
+from spatial.tracking import simplify_track, track_feature, grid_clusters, in_bbox, GridIndex
+
 SSS_DEVICES_URL = SSS_URL + '/api/v1/device/?limit=10000&seen_age__lte=10080&point__isnull=false&format=json'
+SSS_DEVICES_SEEN_URL = SSS_URL + '/api/v1/device/?limit=10000&seen_age__lte={0}&point__isnull=false&format=json'
 SSS_DEVICE_URL = SSS_URL + "/api/v1/device/?deviceid={0}&format=json"
-SSS_HISTORY_URL = SSS_URL + "/api/v1/loggedpoint/?limit=10000&device={0}&seen__gte={1}&seen__lte={2}&format=json"
+SSS_DEVICE_IN_URL = SSS_URL + "/api/v1/device/?deviceid__in={0}&limit={1}&format=json"
+SSS_HISTORY_PAGE_URL = SSS_URL + "/api/v1/loggedpoint/?limit={3}&offset={4}&device={0}&seen__gte={1}&seen__lte={2}&order_by=seen&order_by=id&format=json"
+
+# seconds between incremental polls of SSS for recently seen devices
+POLL_INTERVAL = 60
+# seconds between full re-downloads, which also drop devices that aged out of the week
+FULL_INTERVAL = 600
+# seconds expired devices are remembered for, older since tokens get a full response
+TOMBSTONE_AGE = 3600
+
+# shared cache entry for the full device FeatureCollection, see cached_remote_devices
+CACHE_KEY = "remote_devices_json02"
+CACHE_LOCK = "remote_devices_json02.lock"
+# seconds the payload is fresh, and how long a stale copy may be served while refreshing
+CACHE_FRESH = 60
+CACHE_STALE = 600
+# seconds before going stale to start a background refresh
+CACHE_AHEAD = 10
+# seconds a worker may hold the refresh lock before another can take over
+LOCK_TIMEOUT = 30
+
+# clustering radius in pixels, matches the "cluster" of the tracking layers
+CLUSTER_DISTANCE = 12
+# zoom levels past which devices are returned individually, and the
+# deepest zoom accepted
+CLUSTER_ZOOM = 12
+MAX_ZOOM = 28
+
+# concurrent SSS requests made by one history query
+HISTORY_CONCURRENCY = 8
+# loggedpoint rows per request when streaming history
+HISTORY_PAGE = 1000
 
-def makefeatures(devices):
+logger = logger_setup('remote_devices')
+
+def makefeatures(devices, now=None):
     featureCollection = {
         "crs": None,
         "type": "FeatureCollection",
@@ -18,7 +63,7 @@ def makefeatures(devices):
     for device in devices:
         point = device["point"].split("(")[1].replace(")", "").split(" ")
         seen = datetime.strptime(device["seen"], "%Y-%m-%dT%H:%M:%S")
-        delta = datetime.now() - seen
+        delta = (now or datetime.now()) - seen
         age_minutes = delta.days * 24 * 60 + delta.seconds // 60
         data = {
             "geometry": {
@@ -44,31 +89,554 @@ def makefeatures(devices):
 
     return featureCollection
 
-def remote_devices(request):
+
+# Batched GeoJSON writer, gives the same bytes as json.dumps(makefeatures(...))
+# without building a dict per feature. Key order is taken from makefeatures
+# output so it matches whatever order json.dumps would emit.
+FEATURE_FIELDS = ("x", "y", "id", "name", "altitude", "heading", "symbol",
+    "callsign", "deviceid", "velocity", "logged_time", "age")
+EPOCH = date(1970, 1, 1).toordinal()
+
+def _marker(field):
+    return "\x00" + field
+
+def _feature_template():
+    sample = makefeatures([{"point": "POINT (0 0)", "seen": "1970-01-01T00:00:00",
+        "id": 0, "registration": "", "altitude": 0, "heading": 0, "icon": "",
+        "rin_display": "", "deviceid": "", "velocity": 0}])["features"][0]
+    sample["geometry"]["coordinates"] = [_marker("x"), _marker("y")]
+    sample["id"] = _marker("id")
+    for field in FEATURE_FIELDS[3:]:
+        sample["properties"][field] = _marker(field)
+    template = json.dumps(sample).replace("%", "%%")
+    order = [(template.index(json.dumps(_marker(field))), index) for index, field in enumerate(FEATURE_FIELDS)]
+    for field in FEATURE_FIELDS:
+        template = template.replace(json.dumps(_marker(field)), "%s")
+    return template, itemgetter(*[index for position, index in sorted(order)])
+
+FEATURE_TEMPLATE, FEATURE_ORDER = _feature_template()
+
+def _encode_float(value):
+    encoded = repr(value)
+    if encoded[-1] in "fn": # inf, nan
+        return json.dumps(value)
+    return encoded
+
+ENCODERS = {
+    float: _encode_float,
+    int: str,
+    long: str,
+    bool: lambda value: "true" if value else "false",
+    type(None): lambda value: "null",
+    str: encode_basestring_ascii,
+    unicode: encode_basestring_ascii
+}
+
+def encode(value):
+    return ENCODERS.get(type(value), json.dumps)(value)
+
+def parsecolumns(devices):
+    '''
+    Parse the WKT points and seen timestamps of devices in bulk into columns
+    of x, y and seen (whole seconds since the epoch, local like SSS)
+    '''
+    points = [device["point"].split("(")[1].replace(")", "").split(" ") for device in devices]
+    xs = [float(point[0]) for point in points]
+    ys = [float(point[1]) for point in points]
+    days = {}
+    seens = []
+    for device in devices:
+        seen = device["seen"]
+        day = days.get(seen[:10])
+        if day is None:
+            day = days[seen[:10]] = (datetime.strptime(seen[:10], "%Y-%m-%d").toordinal() - EPOCH) * 86400
+        seens.append(day + int(seen[11:13]) * 3600 + int(seen[14:16]) * 60 + int(seen[17:19]))
+    return xs, ys, seens
+
+def encodefeatures(devices, now=None):
+    '''
+    Yields each device encoded as a GeoJSON Feature string. age and
+    logged_time are computed against a single reference time.
+    '''
+    now = now or datetime.now()
+    now = (now.toordinal() - EPOCH) * 86400 + now.hour * 3600 + now.minute * 60 + now.second
+    xs, ys, seens = parsecolumns(devices)
+    days = {}
+    template, order = FEATURE_TEMPLATE, FEATURE_ORDER
+    for i, device in enumerate(devices):
+        # logged_time is seen shifted back 8 hours to UTC
+        day, seconds = divmod(seens[i] - 28800, 86400)
+        logged_date = days.get(day)
+        if logged_date is None:
+            logged_date = days[day] = date.fromordinal(day + EPOCH).strftime("%Y-%m-%dT")
+        age_minutes = (now - seens[i]) // 60
+        values = (
+            _encode_float(xs[i]),
+            _encode_float(ys[i]),
+            encode(device["id"]),
+            encode(device["registration"]),
+            encode(device["altitude"]),
+            encode(device["heading"]),
+            encode(device["icon"].replace("sss-", "device/")),
+            encode(device["rin_display"]),
+            encode(device["deviceid"]),
+            encode(device["velocity"]),
+            '"%s%02d:%02d:%02d"' % (logged_date, seconds // 3600, seconds // 60 % 60, seconds % 60),
+            encode((age_minutes / 60) + 1)
+        )
+        yield template % order(values)
+
+def iterfeatures(devices, now=None, extra=None, features=None):
+    '''
+    Yields a GeoJSON FeatureCollection of devices in chunks, one per feature.
+    extra adds keys to the collection object (e.g. a delta token), features
+    are any more Feature dicts to append after the devices.
+    '''
+    collection = makefeatures([])
+    collection.update(extra or {})
+    collection["features"] = [_marker("features")]
+    head, tail = json.dumps(collection).split(json.dumps(_marker("features")))
+    yield head
+    separator = ""
+    for feature in encodefeatures(devices, now):
+        yield separator + feature
+        separator = ", "
+    for feature in features or []:
+        yield separator + json.dumps(feature)
+        separator = ", "
+    yield tail
+
+def dumpfeatures(devices, now=None, extra=None, features=None):
+    '''
+    Equivalent of json.dumps(makefeatures(devices)) through iterfeatures
+    '''
+    return "".join(iterfeatures(devices, now, extra, features))
+
+
+class DeviceTable(object):
+    '''
+    In-process table of the devices seen in the past week, keyed by deviceid.
+    The first call downloads the whole window from SSS, later refreshes only
+    ask for devices seen since the previous poll. Each change is stamped with
+    the poll time, and that stamp is the token clients pass back as ?since=
+    to receive just the devices that changed or expired after it.
+    '''
+    def __init__(self):
+        self.devices = {}
+        self.changed = {}
+        self.expired = {}
+        self.started = None
+        self.polled = None
+        self.synced = None
+        self.clusters = {}
+        self.index = None
+        # polling is held for a whole poll of SSS, lock only while the
+        # table is read or the polled rows are merged in
+        self.polling = threading.Lock()
+        self.lock = threading.Lock()
+
+    def refresh(self, request, force=False, maxage=POLL_INTERVAL, wait=False):
+        '''
+        Poll SSS if the table is older than maxage seconds. Only one poll runs
+        at a time, once the table is loaded concurrent callers return straight
+        away and use the current rows instead of waiting on it, unless wait
+        is set. Returns True if the table was polled, by this call or one it
+        waited on, or is within maxage.
+        '''
+        requested = time.time()
+        if not self.polling.acquire(wait or self.started is None):
+            return False
+        try:
+            now = time.time()
+            if not force and self.polled and (now - self.polled < maxage or (wait and self.polled >= requested)):
+                return True
+            full = force or self.synced is None or now - self.synced >= FULL_INTERVAL
+            if full:
+                url = SSS_DEVICES_URL
+            else:
+                # overlap by a minute so devices seen mid-poll aren't missed
+                url = SSS_DEVICES_SEEN_URL.format(int(now - self.polled) // 60 + 2)
+            rows = json.loads(requests.get(request, url).content)["objects"]
+            with self.lock:
+                self.merge(rows, now, full)
+            return True
+        finally:
+            self.polling.release()
+
+    def merge(self, rows, stamp, full=False):
+        '''
+        Upsert rows into the table, when full any device missing from rows
+        has dropped out of the window and is recorded as expired.
+        '''
+        seen = set()
+        for row in rows:
+            deviceid = row["deviceid"]
+            seen.add(deviceid)
+            if self.devices.get(deviceid) != row:
+                self.devices[deviceid] = row
+                self.changed[deviceid] = stamp
+                self.expired.pop(deviceid, None)
+        if full:
+            for deviceid in set(self.devices) - seen:
+                del self.devices[deviceid]
+                del self.changed[deviceid]
+                self.expired[deviceid] = stamp
+            self.synced = stamp
+            self.started = self.started or stamp
+        for deviceid, expired in self.expired.items():
+            if stamp - expired > TOMBSTONE_AGE:
+                del self.expired[deviceid]
+        self.clusters = {}
+        self.index = None
+        self.polled = stamp
+
+    def within(self, bbox):
+        '''
+        Devices inside bbox, from a GridIndex rebuilt once per refresh
+        '''
+        with self.lock:
+            if bbox is None:
+                return self.devices.values()
+            if self.index is None:
+                self.index = GridIndex(self.devices.values())
+            return self.index.query(bbox)
+
+    def clustered(self, zoom):
+        '''
+        grid_clusters of the table at an integer zoom level, computed once
+        per refresh
+        '''
+        with self.lock:
+            if zoom not in self.clusters:
+                cell = CLUSTER_DISTANCE * 360.0 / (256 * 2 ** zoom)
+                self.clusters[zoom] = grid_clusters(self.devices.values(), cell)
+            return self.clusters[zoom]
+
+    def horizon(self):
+        '''
+        Oldest token that can still be answered with a delta
+        '''
+        if self.started is None:
+            return None
+        return max(self.started, self.polled - TOMBSTONE_AGE)
+
+    def changes(self, since):
+        '''
+        Returns (devices, expired deviceids, full) for changes after the since
+        token. Tokens issued by another worker process can be up to a poll
+        apart, so the window is widened by one poll interval; clients apply
+        features as upserts so repeats are harmless. Tokens that aren't a
+        finite number are treated as too old and get a full response.
+        '''
+        with self.lock:
+            try:
+                since = float(since)
+            except (TypeError, ValueError):
+                since = None
+            if since is not None and (math.isnan(since) or math.isinf(since)):
+                since = None
+            horizon = self.horizon()
+            if since is None or horizon is None or since < horizon:
+                return self.devices.values(), [], True
+            since -= POLL_INTERVAL
+            devices = [self.devices[d] for d, stamp in self.changed.items() if stamp > since]
+            expired = [d for d, stamp in self.expired.items() if stamp > since]
+            return devices, expired, False
+
+device_table = DeviceTable()
+
+def remote_devices(request, maxage=POLL_INTERVAL):
     #NEW_SSS_DEVICES = 'https://sss.dpaw.wa.gov.au/api/v1/device/?limit=10000&point__isnull=false&format=json'
     #devices = json.loads(requests.get(request, NEW_SSS_DEVICES).content)["objects"]
-    devices = json.loads(requests.get(request, SSS_DEVICES_URL).content)["objects"]
-    featureCollection = makefeatures(devices)
-    return json.dumps(featureCollection)
+    device_table.refresh(request, maxage=maxage)
+    return dumpfeatures(device_table.devices.values())
+
+def refresh_remote_devices(request):
+    """
+    Rebuild the shared device payload if this worker wins the refresh lock.
+    The lock is a cache.add so it holds across uwsgi processes, returns the
+    new cached_payload or None if another worker is already refreshing.
+    A poll of the device table already in flight in this process is waited
+    on, so the payload is only stamped once the table has been refreshed.
+    """
+    if not cache.add(CACHE_LOCK, True, LOCK_TIMEOUT):
+        return None
+    try:
+        device_table.refresh(request, maxage=0, wait=True)
+        payload = cached_payload(dumpfeatures(device_table.devices.values()))
+        cache.set(CACHE_KEY, (payload, time.time()), CACHE_STALE)
+        return payload
+    finally:
+        cache.delete(CACHE_LOCK)
+
+# held while this process has a background refresh running
+refreshing = threading.Lock()
+
+def background_refresh(request):
+    try:
+        refresh_remote_devices(request)
+    except Exception as e:
+        logger.warning("background device refresh failed: {0!r}".format(e))
+    finally:
+        refreshing.release()
+
+def cached_remote_devices(request):
+    """
+    Device FeatureCollection cached_payload from the shared cache,
+    stale-while-revalidate. Near or past CACHE_FRESH a background thread
+    refreshes the entry (one per process at a time) and the current copy is
+    served meanwhile, so only a cold cache makes a request wait on SSS (and
+    then only one worker fetches, the rest wait for it).
+    """
+    cached = cache.get(CACHE_KEY)
+    if cached:
+        payload, stamp = cached
+        if time.time() - stamp >= CACHE_FRESH - CACHE_AHEAD and refreshing.acquire(False):
+            refresher = threading.Thread(target=background_refresh, args=(request,))
+            refresher.daemon = True
+            refresher.start()
+        return payload
+    payload = refresh_remote_devices(request)
+    waited = 0
+    while payload is None and waited < LOCK_TIMEOUT:
+        time.sleep(0.25)
+        waited += 0.25
+        cached = cache.get(CACHE_KEY)
+        if cached:
+            payload = cached[0]
+        elif not cache.get(CACHE_LOCK):
+            payload = refresh_remote_devices(request)
+    if payload is None:
+        payload = cached_payload(remote_devices(request))
+    return payload
+
+def cluster_zoom(zoom=None, resolution=None):
+    """
+    Integer zoom level for a zoom or a resolution (degrees per pixel),
+    resolutions snap to the nearest level. Raises ValueError for a zoom
+    outside 0 to MAX_ZOOM or a resolution that isn't a positive number.
+    """
+    if zoom is None:
+        if not 0 < resolution < float("inf"):
+            raise ValueError("resolution must be a positive number of degrees per pixel")
+        zoom = int(round(math.log(360.0 / (256 * resolution), 2)))
+        return min(max(zoom, 0), MAX_ZOOM)
+    if not 0 <= zoom <= MAX_ZOOM:
+        raise ValueError("zoom must be between 0 and {0}".format(MAX_ZOOM))
+    return zoom
+
+def remote_devices_clustered(request, zoom, bbox=None):
+    """
+    Device feed clustered for a map view. Devices within CLUSTER_DISTANCE
+    pixels (on a grid) at the given zoom level (see cluster_zoom) are
+    aggregated into cluster features with counts and symbols, and only
+    features inside bbox are returned. Past CLUSTER_ZOOM devices are
+    returned individually.
+    """
+    device_table.refresh(request)
+    if zoom > CLUSTER_ZOOM:
+        return dumpfeatures(device_table.within(bbox), extra={"clustered": False})
+    singles, clusters = device_table.clustered(zoom)
+    return dumpfeatures(
+        [device for x, y, device in singles if in_bbox(x, y, bbox)],
+        extra={"clustered": True},
+        features=[cluster for cluster in clusters if in_bbox(*cluster["geometry"]["coordinates"] + [bbox])])
+
+def remote_devices_bbox(request, bbox):
+    """
+    Devices inside bbox (minx, miny, maxx, maxy)
+    """
+    device_table.refresh(request)
+    return dumpfeatures(device_table.within(bbox))
+
+def remote_devices_since(request, since):
+    """
+    Devices changed or expired since the token from a previous poll, along
+    with a new token. If the token is too old (or missing) every device is
+    returned and "full" is set so the client replaces rather than merges.
+    """
+    device_table.refresh(request)
+    devices, expired, full = device_table.changes(since)
+    return dumpfeatures(devices, extra={
+        "token": repr(device_table.polled),
+        "expired": expired,
+        "full": full
+    })
+
+def fanout(func, items, limit):
+    """
+    Calls func on each item with at most limit calls in flight (greenlets
+    under uwsgi's gevent monkey patching, threads otherwise). Returns a list
+    of (result, exception) pairs in the same order as items.
+    """
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+    def worker():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = (func(item), None)
+            except Exception as e:
+                results[index] = (None, e)
+    workers = [threading.Thread(target=worker) for i in range(min(limit, len(items)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
+
+def remote_device_lookup(request, deviceids):
+    """
+    Device metadata for deviceids as a dict keyed by deviceid. Uses a single
+    deviceid__in query, and looks up any devices missing from its result
+    one by one (concurrently). Devices that can't be found are left out.
+    """
+    deviceids = [unicode(deviceid) for deviceid in deviceids]
+    devices = {}
+    try:
+        rows = json.loads(requests.get(request, SSS_DEVICE_IN_URL.format(",".join(deviceids), len(deviceids))).content)["objects"]
+    except Exception as e:
+        logger.warning("deviceid__in lookup failed: {0}".format(e))
+        rows = []
+    for row in rows:
+        if row["deviceid"] in deviceids:
+            devices[row["deviceid"]] = row
+    missing = [deviceid for deviceid in deviceids if deviceid not in devices]
+    lookup = lambda deviceid: json.loads(requests.get(request, SSS_DEVICE_URL.format(deviceid)).content)["objects"][0]
+    for deviceid, (device, error) in zip(missing, fanout(lookup, missing, HISTORY_CONCURRENCY)):
+        if error:
+            logger.warning("device {0} lookup failed: {1!r}".format(deviceid, error))
+        else:
+            devices[deviceid] = device
+    return devices
+
+def remote_history_pages(request, device, start, end):
+    """
+    Yields the logged points of a device (its SSS id) between start and end
+    (UTC seconds) a page at a time, in (seen, id) order. Each page starts at
+    the last seen second of the one before and skips the points already
+    returned for that second, so pages neither overlap nor skip points.
+    """
+    since, skip = start, 0
+    while True:
+        url = SSS_HISTORY_PAGE_URL.format(device, format_date(since) + "Z", format_date(end) + "Z", HISTORY_PAGE, skip)
+        points = json.loads(requests.get(request, url).content)["objects"]
+        yield points
+        if len(points) < HISTORY_PAGE:
+            return
+        last = seen_utc(points[-1]["seen"])
+        tied = sum(1 for point in points if seen_utc(point["seen"]) == last)
+        skip = skip + tied if last == since else tied
+        since = last
+
+def device_history(request, device, postdict):
+    """
+    Yields lists of history rows (logged points merged with the device
+    metadata) for the postdict window, from the local history store which
+    only asks SSS for the parts of the window it doesn't have yet.
+    """
+    fetch = lambda start, end: remote_history_pages(request, device["id"], start, end)
+    start, end = parse_date(postdict["from_date"]), parse_date(postdict["to_date"])
+    for points in history_store.points(device["id"], start, end, fetch):
+        rows = list()
+        for point in points:
+            row = device.copy()
+            row.update(point)
+            rows.append(row)
+        yield rows
+
+def check_history_options(postdict):
+    """
+    Raises ValueError unless the optional simplify and resolution settings
+    in postdict are positive numbers (or missing).
+    """
+    for key in ("simplify", "resolution"):
+        try:
+            value = float(postdict.get(key) or 0)
+        except (TypeError, ValueError):
+            value = None
+        if value is None or not 0 <= value < float("inf"):
+            raise ValueError("{0} must be a positive number".format(key))
+
+def reduce_history(rows, postdict):
+    """
+    Apply the optional simplify (metres) and resolution (minutes) settings
+    from postdict to the rows of one device track.
+    """
+    simplify = float(postdict.get("simplify") or 0)
+    resolution = float(postdict.get("resolution") or 0)
+    if not (simplify or resolution):
+        return rows
+    return simplify_track(rows, simplify, resolution)
 
 def remote_history(request,postdict):
     """
     Sample postdict:
         {"from_date":"2015-01-06 00:40","to_date":"2015-01-06 03:40","unique_list":["300034012174320"]}
+
+    Optional postdict keys:
+        simplify: Douglas-Peucker tolerance in metres for each track
+        resolution: keep one point per this many minutes of each track
+        lines: also return a LineString feature per device track
+
+    History for each device is fetched concurrently and merged in unique_list
+    order. Devices that fail are listed under "errors" rather than failing
+    the whole response.
     """
+    deviceids = [unicode(deviceid) for deviceid in postdict["unique_list"]]
+    lookup = remote_device_lookup(request, deviceids)
+    def history(deviceid):
+        return reduce_history([row for rows in device_history(request, lookup[deviceid], postdict) for row in rows], postdict)
     devices = list()
-    
-    for device in postdict["unique_list"]:
-        device = json.loads(requests.get(request,SSS_DEVICE_URL.format(device)).content)["objects"][0]
-        params = [
-            device["id"],
-            postdict["from_date"] + "Z",
-            postdict["to_date"] + "Z"
-        ]
-        points =  json.loads(requests.get(request,SSS_HISTORY_URL.format(*params)).content)["objects"]
-        for point in points:
-            row = device.copy()
-            row.update(point)
-            devices.append(row)
-    featureCollection = makefeatures(devices)
-    return json.dumps(featureCollection)
+    errors = list()
+    tracks = list()
+    for deviceid, (rows, error) in zip(deviceids, fanout(history, deviceids, HISTORY_CONCURRENCY)):
+        if error:
+            logger.warning("device {0} history failed: {1!r}".format(deviceid, error))
+            errors.append(deviceid)
+            continue
+        devices.extend(rows)
+        if postdict.get("lines") and rows:
+            tracks.append(track_feature(rows))
+    return dumpfeatures(devices, extra={"errors": errors} if errors else None, features=tracks)
+
+def stream_history(request, postdict):
+    """
+    Streaming remote_history for a StreamingHttpResponse. Works through the
+    devices one at a time and yields features a day of history at a time,
+    so only that much is held in memory. Devices that fail are listed under
+    "errors" at the end of the collection.
+
+    simplify and resolution are applied to each day of a track on its own,
+    with lines the reduced points are kept to emit each device's LineString.
+    """
+    deviceids = [unicode(deviceid) for deviceid in postdict["unique_list"]]
+    lookup = remote_device_lookup(request, deviceids)
+    now = datetime.now()
+    errors = list()
+    separator = ""
+    yield '{"crs": null, "type": "FeatureCollection", "features": ['
+    for deviceid in deviceids:
+        track = list()
+        try:
+            if deviceid not in lookup:
+                raise KeyError(deviceid)
+            for rows in device_history(request, lookup[deviceid], postdict):
+                rows = reduce_history(rows, postdict)
+                if postdict.get("lines"):
+                    track.extend(rows)
+                for feature in encodefeatures(rows, now):
+                    yield separator + feature
+                    separator = ", "
+        except Exception as e:
+            logger.warning("device {0} history failed: {1!r}".format(deviceid, e))
+            errors.append(deviceid)
+        if track:
+            yield separator + json.dumps(track_feature(track))
+            separator = ", "
+    yield '], "errors": {0}}}'.format(json.dumps(errors))
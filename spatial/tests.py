@@ -5,7 +5,28 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import json
+import shutil
+import time
+import tempfile
+from datetime import datetime
+from unittest import skipIf
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, SimpleTestCase, RequestFactory
+from django.test.utils import override_settings
+
+from messaging.models import AuditCollision, start_audit_local, finish_audit_local
+from spatial.catalogue import write_snapshot, snapshot_changed, snapshot_url
+from spatial.models import Map, RasterLayer, catalogue_version
+from spatial.history import HistoryStore, HISTORY_SETTLE, SEEN_OFFSET, parse_date, subtract
+from spatial.remote_devices import DeviceTable, TOMBSTONE_AGE, dumpfeatures, makefeatures
+from spatial.tracking import parse_bbox
+from spatial.printing import PrintQueue, PrintResults, print_key, composite, layer_bands, gdal, numpy
+from spatial.views import layer_list, map_list
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +42,313 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+class LayerListTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(id=1, username="sss", email="sss@example.com")
+        for layer_id, layer_type in [("roads", "line"), ("fires", "polygon"), ("towns", "point"),
+                ("aerial", "imagery"), ("grid", "overlay"), ("tracks", "line")]:
+            RasterLayer.objects.create(layer_id=layer_id, name=layer_id.title(), details={},
+                layer_type=layer_type, layers=layer_id, url="//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms",
+                effective_from=datetime.utcnow())
+        self.static_root = tempfile.mkdtemp()
+        with open(os.path.join(self.static_root, "layerorder.json"), "w") as layerorder:
+            layerorder.write(json.dumps({"layers": ["tracks", "grid", "towns", "missing"]}))
+        self.request = RequestFactory().get("/apps/spatial/layers.json")
+        self.request.user = self.user
+        cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.static_root)
+
+    def test_ordered_layers_query_count(self):
+        """
+        The ordered catalogue loads every layer in one query, however many
+        layers there are (plus one for the embedded map list).
+        """
+        with override_settings(STATIC_ROOT=self.static_root):
+            with self.assertNumQueries(2):
+                response = layer_list(self.request, fmt="json")
+        ids = [layer["id"] for layer in json.loads(response.content)["layers"]]
+        self.assertEqual(ids[2:], ["towns", "tracks", "roads", "fires", "grid", "aerial"])
+
+    def test_catalogue_invalidated_on_save(self):
+        with override_settings(STATIC_ROOT=self.static_root):
+            layer_list(self.request, fmt="json")
+            RasterLayer.objects.create(layer_id="burns", name="Burns", details={},
+                layer_type="polygon", layers="burns", url="//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms",
+                effective_from=datetime.utcnow())
+            response = layer_list(self.request, fmt="json")
+        ids = [layer["id"] for layer in json.loads(response.content)["layers"]]
+        self.assertIn("burns", ids)
+
+    def test_catalogue_snapshot(self):
+        with override_settings(STATIC_ROOT=self.static_root):
+            name = write_snapshot()
+            self.assertEqual(snapshot_url(), settings.STATIC_URL + name)
+            built = time.time()
+            self.assertFalse(snapshot_changed(built))
+            RasterLayer.objects.filter(layer_id="roads").delete()
+            self.assertTrue(snapshot_changed(built))
+        with open(os.path.join(self.static_root, name)) as catalogue:
+            ids = [layer["id"] for layer in json.loads(catalogue.read())["layers"]]
+        self.assertEqual(ids[2:], ["towns", "tracks", "roads", "fires", "grid", "aerial"])
+
+    def test_map_list_matches_as_json(self):
+        for map_id, name in (("fires", "Fires"), ("burns", "Burns"), ("roads", "Roads")):
+            Map.objects.create(map_id=map_id, name=name, layers=[{"layer_id": "roads", "opacity": 1}],
+                center="POINT (116.5 -31.25)", immutable=False, workdir="/tmp/" + map_id + "_1",
+                effective_from=datetime.utcnow())
+        request = RequestFactory().get("/apps/spatial/maps.json", {"limit": 2, "offset": 1})
+        request.user = self.user
+        response = map_list(request, fmt="json")
+        expected = [m.as_json(user=self.user) for m in Map.objects.order_by("name")]
+        self.assertEqual(json.loads(response.content), expected[1:])
+        self.assertEqual(response["X-Total-Count"], "3")
+        self.assertEqual(map_list(request, fmt="dict"), expected)
+
+
+class DeviceTableTest(SimpleTestCase):
+    def changes(self, table, since):
+        devices, expired, full = table.changes(since)
+        return sorted(device["deviceid"] for device in devices), sorted(expired), full
+
+    def test_changes_since_token(self):
+        table = DeviceTable()
+        self.assertEqual(self.changes(table, "1000"), ([], [], True))
+        table.merge([{"deviceid": "a", "seen": "1"}, {"deviceid": "b", "seen": "1"}], 1000, full=True)
+        self.assertEqual(self.changes(table, None), (["a", "b"], [], True))
+        table.merge([{"deviceid": "a", "seen": "2"}, {"deviceid": "b", "seen": "1"}], 1100)
+        self.assertEqual(self.changes(table, "1100"), (["a"], [], False))
+        # widened by a poll interval for tokens from another worker
+        self.assertEqual(self.changes(table, "1130"), (["a"], [], False))
+        self.assertEqual(self.changes(table, "1000"), (["a", "b"], [], False))
+        table.merge([{"deviceid": "a", "seen": "2"}], 1200, full=True)
+        self.assertEqual(self.changes(table, "1200"), ([], ["b"], False))
+        table.merge([{"deviceid": "b", "seen": "3"}], 1300)
+        self.assertEqual(self.changes(table, "1300"), (["b"], [], False))
+
+    def test_tombstones_expire_past_horizon(self):
+        table = DeviceTable()
+        table.merge([{"deviceid": "a", "seen": "1"}, {"deviceid": "b", "seen": "1"}], 1000, full=True)
+        table.merge([{"deviceid": "a", "seen": "1"}], 1200, full=True)
+        later = 1200 + TOMBSTONE_AGE + 1
+        table.merge([], later)
+        self.assertEqual(table.expired, {})
+        self.assertEqual(self.changes(table, "1200"), (["a"], [], True))
+        self.assertEqual(self.changes(table, str(later)), ([], [], False))
+
+    def test_bad_tokens_get_full_response(self):
+        table = DeviceTable()
+        table.merge([{"deviceid": "a", "seen": "1"}], 1000, full=True)
+        for token in ("", "abc", "nan", "inf", "-inf", "1e400"):
+            self.assertEqual(self.changes(table, token), (["a"], [], True), token)
+
+
+class DumpFeaturesTest(SimpleTestCase):
+    def test_same_bytes_as_makefeatures(self):
+        now = datetime(2016, 1, 15, 12, 30, 45)
+        rows = []
+        for i, (seen, name, altitude) in enumerate([
+                ("2016-01-15T12:30:45", u"NAR 1", 120.5),
+                ("2016-01-08T23:59:59", u"Fire truck \u00e9\u2603 \"2\"", None),
+                # clock skew, seen after now
+                ("2016-01-15T12:32:10", None, 0),
+                ("2016-01-01T00:00:00", u"", -3)]):
+            rows.append({"id": i, "point": "POINT ({0} -31.{1})".format(116.1 + i, i), "seen": seen,
+                "registration": name, "altitude": altitude, "heading": None if i % 2 else 90,
+                "icon": "sss-2_wheel_drive", "rin_display": u"RIN\u00b0{0}".format(i),
+                "deviceid": str(1000 + i), "velocity": 0.1 * i})
+        self.assertEqual(dumpfeatures(rows, now), json.dumps(makefeatures(rows, now)))
+        self.assertEqual(dumpfeatures([], now), json.dumps(makefeatures([], now)))
+
+
+class HistoryStoreTest(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = HistoryStore(self.root)
+        self.calls = []
+        self.upstream = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def point(self, pk, when):
+        seen = datetime.utcfromtimestamp(when + SEEN_OFFSET).strftime("%Y-%m-%dT%H:%M:%S")
+        self.upstream.append({"id": pk, "seen": seen, "point": "POINT (116 -31)"})
+
+    def fetch(self, start, end):
+        self.calls.append((start, end))
+        # the first point comes back twice, as it can when SSS pages overlap
+        page = [p for p in self.upstream if start <= parse_date(p["seen"].replace("T", " ")) - SEEN_OFFSET <= end]
+        return [page, page[:1]]
+
+    def points(self, start, end):
+        return [p["id"] for day in self.store.points("1", start, end, self.fetch) for p in day]
+
+    def test_subtract(self):
+        self.assertEqual(subtract((0, 10), [(6, 8), (2, 4)]), [(0, 2), (4, 6), (8, 10)])
+        self.assertEqual(subtract((0, 10), [(0, 10)]), [])
+        self.assertEqual(subtract((3, 5), [(0, 4)]), [(4, 5)])
+
+    def test_only_gaps_fetched(self):
+        start = parse_date("2016-01-15 00:00")
+        for pk, minutes in enumerate([10, 100, 200, 300]):
+            self.point(pk, start + minutes * 60)
+        self.assertEqual(self.points(start, start + 6 * 3600), [0, 1, 2, 3])
+        self.assertEqual(self.calls, [(start, start + 6 * 3600)])
+        self.assertEqual(self.points(start + 3600, start + 4 * 3600), [1, 2])
+        self.assertEqual(len(self.calls), 1)
+        # across midnight UTC, only the new part of each day goes upstream
+        self.point(4, start + 23 * 3600)
+        self.point(5, start + 25 * 3600)
+        self.assertEqual(self.points(start + 3600, start + 26 * 3600), [1, 2, 3, 4, 5])
+        self.assertEqual(self.calls[1:], [(start + 6 * 3600 + 1, start + 86400 - 1),
+            (start + 86400, start + 26 * 3600)])
+
+    def test_recent_spans_not_stored(self):
+        now = int(time.time())
+        self.point(1, now - 2 * HISTORY_SETTLE)
+        self.point(2, now - 60)
+        self.assertEqual(self.points(now - 3 * HISTORY_SETTLE, now), [1, 2])
+        calls = len(self.calls)
+        self.point(3, now - 30)
+        self.assertEqual(self.points(now - 3 * HISTORY_SETTLE, now), [1, 2, 3])
+        # only the unsettled end of the window is asked for again
+        self.assertTrue(self.calls[calls:])
+        for low, high in self.calls[calls:]:
+            self.assertGreaterEqual(low, now - HISTORY_SETTLE - 1)
+
+
+class ParseBboxTest(SimpleTestCase):
+    def test_four_finite_ordered_values(self):
+        self.assertIsNone(parse_bbox(""))
+        self.assertEqual(parse_bbox("115,-32,117.5,-30"), (115, -32, 117.5, -30))
+        self.assertEqual(parse_bbox("-1e300,-100,1e300,100"), (-180, -90, 180, 90))
+        for value in ("nan,0,1,1", "0,0,inf,1", "1,2,3", "1,2,3,4,5", "2,0,1,1", "0,2,1,1", "a,b,c,d"):
+            self.assertRaises(ValueError, parse_bbox, value)
+
+
+class LazyJSONFieldTest(TestCase):
+    def test_decoded_on_access_and_saved_as_loaded(self):
+        User.objects.create(id=1, username="sss", email="sss@example.com")
+        RasterLayer.objects.create(layer_id="roads", name="Roads", details={"tags": ["roads"]},
+            layer_type="line", layers="roads", url="//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms",
+            effective_from=datetime.utcnow())
+        layer = RasterLayer.objects.get(layer_id="roads")
+        self.assertFalse(layer.__dict__["details"].decoded)
+        layer.save()
+        layer = RasterLayer.objects.get(layer_id="roads")
+        layer.details["tags"].append("transport")
+        layer.save()
+        self.assertEqual(RasterLayer.objects.get(layer_id="roads").details, {"tags": ["roads", "transport"]})
+
+
+class AuditCacheTest(TestCase):
+    def test_get_version_cached_until_cleared(self):
+        User.objects.create(id=1, username="sss", email="sss@example.com")
+        layer = RasterLayer(layer_id="roads", name="Roads", details={}, layer_type="line", layers="roads",
+            url="//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms")
+        layer.save_version()
+        self.assertEqual(layer.get_version().name, "Roads")
+        with self.assertNumQueries(0):
+            self.assertEqual(layer.get_version().name, "Roads")
+        update = RasterLayer(layer_id="roads", name="Main Roads", details={}, layer_type="line", layers="roads",
+            url="//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms")
+        update.save_version()
+        self.assertEqual(layer.get_version().name, "Main Roads")
+
+    def test_request_local_results_are_copies(self):
+        User.objects.create(id=1, username="sss", email="sss@example.com")
+        layer = RasterLayer(layer_id="roads", name="Roads", details={}, layer_type="line", layers="roads",
+            url="//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms")
+        layer.save_version()
+        start_audit_local()
+        try:
+            layer.get_version().name = "Changed"
+            with self.assertNumQueries(0):
+                self.assertEqual(layer.get_version().name, "Roads")
+        finally:
+            finish_audit_local()
+
+    def test_bulk_save_versions(self):
+        User.objects.create(id=1, username="sss", email="sss@example.com")
+        RasterLayer(layer_id="roads", name="Roads", details={}, layer_type="line", layers="roads",
+            url="//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms").save_version()
+        layers = [RasterLayer(layer_id=layer_id, name=name, details={}, layer_type="line", layers=layer_id,
+            url="//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms") for layer_id, name in (("roads", "Main Roads"), ("tracks", "Tracks"))]
+        version = catalogue_version()
+        RasterLayer.objects.bulk_save_versions(layers)
+        self.assertNotEqual(catalogue_version(), version)
+        self.assertEqual(RasterLayer.objects.filter(layer_id="roads").count(), 2)
+        self.assertEqual(RasterLayer.objects.get(layer_id="roads", effective_to=None).name, "Main Roads")
+        self.assertEqual(layers[0].get_version().name, "Main Roads")
+        with self.assertRaises(AuditCollision):
+            RasterLayer.objects.bulk_save_versions([RasterLayer(layer_id="tracks", name="Tracks", details={},
+                layer_type="line", layers="tracks", url="//kmi.dpaw.wa.gov.au/geoserver/gwc/service/wms")])
+
+
+class PrintQueueTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.queue = PrintQueue(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_jobs_claimed_in_order_once(self):
+        first = self.queue.submit({"user": 1, "fmt": "pdf"})
+        second = self.queue.submit({"user": 1, "fmt": "jpg"})
+        self.assertEqual(self.queue.position(self.queue.get(second)), 1)
+        self.assertEqual(self.queue.claim()["id"], first)
+        self.assertEqual(self.queue.claim()["id"], second)
+        self.assertIsNone(self.queue.claim())
+        self.queue.finish(first, "/tmp/{0}.pdf".format(first), "application/pdf", "map.pdf")
+        job = self.queue.get(first)
+        self.assertEqual((job["status"], job["params"]), ("done", None))
+        self.assertEqual(os.stat(self.queue.path).st_mode & 0o777, 0o600)
+
+    def test_print_results_keyed_on_map_state(self):
+        user = User(email="sss@example.com")
+        state = {"layers": [{"layer_id": "roads", "opacity": 1}], "center": {"coordinates": [116.5, -31.25]}, "scale": 50000}
+        jittered = json.loads(json.dumps({"scale": "50000", "center": {"coordinates": [116.500000001, -31.25]},
+            "layers": [{"opacity": 1.0, "layer_id": "roads"}]}))
+        key = print_key(state, "Fires", user, "inkscape_a3_landscape", 200, "pdf")
+        self.assertEqual(print_key(jittered, "Fires", user, "inkscape_a3_landscape", 200, "pdf"), key)
+        self.assertNotEqual(print_key(state, "Fires", user, "inkscape_a3_landscape", 200, "jpg"), key)
+        results = PrintResults(os.path.join(self.root, "results"), 10, 600)
+        self.assertIsNone(results.get(key, "pdf"))
+        output = os.path.join(self.root, "output.pdf")
+        with open(output, "w") as rendered:
+            rendered.write("%PDF")
+        path = results.put(key, "pdf", output)
+        with results.get(key, "pdf") as stored:
+            self.assertEqual(stored.name, path)
+        self.assertFalse(os.path.exists(output))
+        # a print over the size limit is kept, older ones make room for it
+        large = print_key(state, "Fires", user, "inkscape_a3_landscape", 200, "jpg")
+        with open(output, "w") as rendered:
+            rendered.write("0123456789abcdef")
+        self.assertTrue(os.path.exists(results.put(large, "jpg", output)))
+        self.assertIsNone(results.get(key, "pdf"))
+
+
+@skipIf(gdal is None, "needs GDAL and NumPy")
+class CompositeTest(TestCase):
+    def test_layers_composited_in_order(self):
+        red = numpy.zeros((3, 2, 2), numpy.uint8)
+        red[0] = 255
+        # a single band layer, black on the left and white (keyed out) on the right
+        grey = numpy.array([[0, 255], [0, 255]], numpy.uint8)
+        stack = [{"location": layer_bands(red, False), "opacity": 1},
+            {"location": layer_bands(grey, True), "opacity": "0.5"}]
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, "composite.png")
+            composite(stack, path)
+            output = gdal.Open(path).ReadAsArray()
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual(output.shape, (3, 2, 2))
+        self.assertEqual(output[:, 0, 0].tolist(), [128, 0, 0])
+        self.assertEqual(output[:, 0, 1].tolist(), [255, 0, 0])
@@ -0,0 +1,212 @@
+'''
+Geometry helpers for resource tracking features: track simplification
+and downsampling for history output, and grid clustering and a spatial
+index of the live device feed.
+
+Rows are SSS device or logged point dicts with a WKT "point" and a local
+"seen" timestamp, as passed to remote_devices.makefeatures.
+'''
+from __future__ import division, print_function, absolute_import
+
+import math
+
+from spatial.history import seen_utc
+
+# metres per degree of latitude, longitude is scaled by cos(latitude)
+METRES_PER_DEGREE = 111320.0
+
+
+def point_xy(row):
+    point = row["point"].split("(")[1].replace(")", "").split(" ")
+    return float(point[0]), float(point[1])
+
+def project(coords):
+    '''
+    Equirectangular projection to metres around the mean latitude, plenty
+    accurate over the extent of a single track.
+    '''
+    if not coords:
+        return []
+    scale = math.cos(math.radians(sum(y for x, y in coords) / len(coords)))
+    return [(x * METRES_PER_DEGREE * scale, y * METRES_PER_DEGREE) for x, y in coords]
+
+def douglas_peucker(points, tolerance):
+    '''
+    Indexes of points kept by Douglas-Peucker simplification, points are
+    projected (x, y) in the same units as tolerance.
+    '''
+    if len(points) < 3:
+        return range(len(points))
+    keep = set([0, len(points) - 1])
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = math.hypot(dx, dy)
+        furthest, index = 0, None
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if length:
+                distance = abs(dy * x - dx * y + x2 * y1 - y2 * x1) / length
+            else:
+                distance = math.hypot(x - x1, y - y1)
+            if distance > furthest:
+                furthest, index = distance, i
+        if index is not None and furthest > tolerance:
+            keep.add(index)
+            stack.append((first, index))
+            stack.append((index, last))
+    return sorted(keep)
+
+def downsample(rows, minutes):
+    '''
+    First row in each interval of minutes, plus the last row of the track
+    '''
+    kept, last = [], None
+    for row in rows:
+        interval = seen_utc(row["seen"]) // (minutes * 60)
+        if interval != last:
+            kept.append(row)
+            last = interval
+    if rows and kept[-1] is not rows[-1]:
+        kept.append(rows[-1])
+    return kept
+
+def simplify_track(rows, simplify=None, resolution=None):
+    '''
+    Reduce the rows of one device track, binning to one point per
+    resolution minutes and then simplifying to within simplify metres.
+    rows are sorted by seen first.
+    '''
+    rows = sorted(rows, key=lambda row: row["seen"])
+    if resolution:
+        rows = downsample(rows, resolution)
+    if simplify:
+        points = project([point_xy(row) for row in rows])
+        rows = [rows[i] for i in douglas_peucker(points, simplify)]
+    return rows
+
+def track_feature(rows):
+    '''
+    LineString Feature through the rows of one device track, a track of a
+    single row is a Point as a LineString needs two positions
+    '''
+    device = rows[0]
+    coordinates = [list(point_xy(row)) for row in rows]
+    return {
+        "geometry": {
+            "type": "LineString",
+            "coordinates": coordinates
+        } if len(coordinates) > 1 else {
+            "type": "Point",
+            "coordinates": coordinates[0]
+        },
+        "type": "Feature",
+        "id": "{0}_track".format(device["deviceid"]),
+        "properties": {
+            "name": device["registration"],
+            "callsign": device["rin_display"],
+            "deviceid": device["deviceid"],
+            "symbol": device["icon"].replace("sss-", "device/"),
+            "points": len(rows),
+            "track": True
+        }
+    }
+
+def in_bbox(x, y, bbox):
+    return bbox is None or (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3])
+
+# device positions are longitude/latitude, wider bboxes are clipped to it
+WORLD = (-180.0, -90.0, 180.0, 90.0)
+
+def parse_bbox(value):
+    '''
+    (minx, miny, maxx, maxy) from a "minx,miny,maxx,maxy" string, or None.
+    Raises ValueError unless there are exactly four finite values with min
+    no greater than max.
+    '''
+    if not value:
+        return None
+    bbox = [float(v) for v in value.split(",")]
+    if (len(bbox) != 4 or any(math.isnan(v) or math.isinf(v) for v in bbox)
+            or bbox[0] > bbox[2] or bbox[1] > bbox[3]):
+        raise ValueError("bbox needs minx,miny,maxx,maxy: {0}".format(value))
+    return (max(bbox[0], WORLD[0]), max(bbox[1], WORLD[1]), min(bbox[2], WORLD[2]), min(bbox[3], WORLD[3]))
+
+class GridIndex(object):
+    '''
+    Spatial index of devices on a fixed grid of cell degrees, bbox queries
+    only visit the cells overlapping the bbox. Built once per device table
+    refresh, a week of devices is a few thousand points so a grid does as
+    well as an R-tree and is far cheaper to rebuild.
+    '''
+    def __init__(self, devices, cell=0.25):
+        self.cell = cell
+        self.cells = {}
+        for device in devices:
+            x, y = point_xy(device)
+            self.cells.setdefault(self.key(x, y), []).append((x, y, device))
+
+    def key(self, x, y):
+        return int(math.floor(x / self.cell)), int(math.floor(y / self.cell))
+
+    def query(self, bbox):
+        '''
+        Devices inside bbox (minx, miny, maxx, maxy)
+        '''
+        (minx, miny), (maxx, maxy) = self.key(*bbox[:2]), self.key(*bbox[2:])
+        if (maxx - minx + 1) * (maxy - miny + 1) > len(self.cells):
+            # bbox spans more cells than are occupied, walk the occupied ones
+            keys = [key for key in self.cells if minx <= key[0] <= maxx and miny <= key[1] <= maxy]
+        else:
+            keys = [(kx, ky) for kx in range(minx, maxx + 1) for ky in range(miny, maxy + 1)]
+        devices = []
+        for key in keys:
+            for x, y, device in self.cells.get(key, []):
+                if in_bbox(x, y, bbox):
+                    devices.append(device)
+        return devices
+
+def grid_clusters(devices, cell):
+    '''
+    Groups devices into square grid cells of cell degrees. Returns the
+    devices that are alone in their cell as (x, y, device) and a cluster
+    Feature for each cell holding more than one device.
+    '''
+    cells = {}
+    for device in devices:
+        x, y = point_xy(device)
+        key = (int(math.floor(x / cell)), int(math.floor(y / cell)))
+        cells.setdefault(key, []).append((x, y, device))
+    singles, clusters = [], []
+    for key, members in cells.items():
+        if len(members) == 1:
+            singles.append(members[0])
+        else:
+            clusters.append(cluster_feature(key, members))
+    return singles, clusters
+
+def cluster_feature(key, members):
+    '''
+    Point Feature at the centroid of members with the device count and a
+    count per symbol, symbol is the most common one.
+    '''
+    symbols = {}
+    for x, y, device in members:
+        symbol = device["icon"].replace("sss-", "device/")
+        symbols[symbol] = symbols.get(symbol, 0) + 1
+    return {
+        "geometry": {
+            "type": "Point",
+            "coordinates": [sum(m[0] for m in members) / len(members), sum(m[1] for m in members) / len(members)]
+        },
+        "type": "Feature",
+        "id": "cluster_{0}_{1}".format(*key),
+        "properties": {
+            "count": len(members),
+            "symbol": max(symbols, key=lambda symbol: (symbols[symbol], symbol)),
+            "symbols": symbols,
+            "cluster": True
+        }
+    }
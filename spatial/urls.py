@@ -6,5 +6,8 @@ urlpatterns = patterns('spatial.views',
     url(r'^/query_vector/(?P<layerid>\w+)\.json$', 'query_vector_layer'),
     url(r'^/maps$', 'map_list'),
     url(r'^/print\.(?P<fmt>\w+)$', 'print'),
+    url(r'^/print/jobs\.(?P<fmt>\w+)$', 'print_submit'),
+    url(r'^/print/jobs/(?P<job_id>\w+)$', 'print_status'),
+    url(r'^/print/jobs/(?P<job_id>\w+)/result$', 'print_result'),
     url(r'^/maps\.(?P<fmt>\w+)$', 'map_list'),
 )
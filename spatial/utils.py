@@ -1,15 +1,31 @@
 from __future__ import print_function
+import gzip
+import hashlib
+import json
 import logging
 import logging.handlers
 import os
 import subprocess
 import urllib
+from cStringIO import StringIO
+
+from django import http
+from django.conf import settings
+
 from spatial.models import RasterLayer
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 def logger_setup(name):
     # Set up logging in a standardised way.                                                            
     logger = logging.getLogger(name)                                                                   
+    if logger.handlers:
+        # already set up, another handler would log every line twice
+        return logger
     logger.setLevel(logging.DEBUG)                                                                     
     fh = logging.handlers.RotatingFileHandler(                                                         
         '/tmp/{0}.log'.format(name), maxBytes=20*1024*1024, backupCount=5)                              
@@ -20,6 +36,100 @@ def logger_setup(name):
     return logger
 
 
+def cached_payload(content):
+    '''
+    Response content along with its gzip (and brotli, if installed) encodings
+    and an etag, so cached responses are compressed once rather than on
+    every request. Use with payload_response.
+    '''
+    payload = {
+        "content": content,
+        "etag": 'W/"{0}"'.format(hashlib.sha1(content).hexdigest())
+    }
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6, mtime=0) as gz:
+        gz.write(content)
+    payload["gzip"] = buf.getvalue()
+    if brotli:
+        payload["br"] = brotli.compress(content)
+    return payload
+
+
+def accepted_encodings(request):
+    encodings = set()
+    for item in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        params = item.strip().split(";")
+        if any(param.strip() in ("q=0", "q=0.0", "q=0.00", "q=0.000") for param in params[1:]):
+            continue
+        encodings.add(params[0].strip().lower())
+    return encodings
+
+
+def payload_response(request, payload, content_type, max_age, public=True):
+    '''
+    HttpResponse for a cached_payload, 304 if the client already has it
+    (If-None-Match) otherwise the best precomputed encoding it accepts.
+    '''
+    etags = [etag.strip() for etag in request.META.get("HTTP_IF_NONE_MATCH", "").split(",")]
+    if payload["etag"] in etags or "*" in etags:
+        response = http.HttpResponseNotModified()
+    else:
+        accepted = accepted_encodings(request)
+        for encoding in ("br", "gzip"):
+            if encoding in payload and encoding in accepted:
+                response = http.HttpResponse(payload[encoding], content_type=content_type)
+                response["Content-Encoding"] = encoding
+                break
+        else:
+            response = http.HttpResponse(payload["content"], content_type=content_type)
+    response["ETag"] = payload["etag"]
+    response["Vary"] = "Accept-Encoding"
+    response["Cache-Control"] = "max-age={0}, {1}".format(max_age, "public" if public else "private")
+    return response
+
+
+class LayerOrder(object):
+    '''
+    Parsed layerorder.json: data is the whole file (views, tracking,
+    layerfilters, layers), layers the ordered layer ids, ids the same as a
+    set and index maps each id to its position. data and layers are None if
+    the file is missing or unreadable.
+    '''
+    def __init__(self, path, stamp):
+        self.stamp = stamp
+        self.data, self.layers = None, None
+        try:
+            with open(path) as layerorder:
+                self.data = json.loads(layerorder.read())
+            self.layers = list(self.data["layers"])
+        except (IOError, ValueError, TypeError, KeyError):
+            pass
+        self.ids = set(self.layers or [])
+        self.index = {}
+        for position, layer_id in enumerate(self.layers or []):
+            self.index.setdefault(layer_id, position)
+        self.version = "{0}.{1}".format(stamp[1], stamp[2])
+
+
+_layer_order = None
+
+def layer_order():
+    '''
+    LayerOrder for STATIC_ROOT/layerorder.json, parsed once per process and
+    only reparsed when the files inode or mtime changes.
+    '''
+    global _layer_order
+    path = os.path.join(settings.STATIC_ROOT, "layerorder.json")
+    try:
+        stat = os.stat(path)
+        stamp = (path, stat.st_ino, int(stat.st_mtime * 1000))
+    except OSError:
+        stamp = (path, 0, 0)
+    if _layer_order is None or _layer_order.stamp != stamp:
+        _layer_order = LayerOrder(path, stamp)
+    return _layer_order
+
+
 def ge_wms_rasterlayers(current=True):
     '''
     A convenience function to return a queryset of RasterLayer objects that are
@@ -27,12 +27,7 @@ import json
 import requests
 import tempfile
 import subprocess
-import time
-import calendar
 import shutil
-from datetime import datetime
-
-from geopy import distance
 
 from django import http
 from django.core.cache import cache
@@ -40,12 +35,13 @@ from django.conf import settings
 from django.shortcuts import render_to_response
 from django.contrib.auth.decorators import login_required
 
-from messaging.models import JSONEncoder
-from spatial.models import Map, Layer, RasterLayer
-from spatial.remote_devices import remote_devices, remote_history
-from spatial.utils import logger_setup
-
-GDAL_TRANSLATE = os.path.join(settings.GDAL_APPS, "gdal_translate")
+from messaging.models import JSONEncoder, dumps
+from spatial.models import Map, Layer, RasterLayer, catalogue_version
+from spatial.remote_devices import cached_remote_devices, check_history_options, cluster_zoom, remote_devices_bbox, remote_devices_clustered, remote_devices_since, remote_history, stream_history
+from spatial.tracking import parse_bbox
+from spatial.utils import cached_payload, payload_response, layer_order
+from spatial.printing import GDAL_TRANSLATE, MIMETYPES, WORKDIR_ROOT, PrintError, print_logger, print_map, print_key, render_print, print_queue, print_results
+from spatial.catalogue import TRACKING_LAYERS, system_layers, user_layers, snapshot_url, map_rows, maps_dict, maps_text
 
 def context(request):
     return {"site_name": "Spatial Support System",
@@ -53,18 +49,18 @@ def context(request):
             "messages": [],
             "user": request.user}
 
-# sizes in mm: x, y
-document_sizes = {
-    "inkscape_a3_portrait": (272, 352),
-    "inkscape_a3_landscape": (391, 232)
-}
+# seconds cached catalogue parts are kept, they are invalidated by version
+CATALOGUE_TIMEOUT = 86400
+
 
 
 @login_required
 def standardmap(request):
     getparams = json.dumps(request.GET, cls=JSONEncoder)
-    orderedloc = os.path.join(settings.STATIC_ROOT, "layerorder.json")
-    orderedstuff = json.loads(open(orderedloc).read())
+    # static snapshot of the shared catalogue, if built, for the client to
+    # load in place of layers.json (which still serves the whole catalogue)
+    layer_catalogue = snapshot_url() or ""
+    orderedstuff = layer_order().data
     try:
         viewfilters = orderedstuff["views"]
         trackingfilters = orderedstuff["tracking"]
@@ -103,14 +99,44 @@ def map_list(request, fmt="html"):
         user = request.user
         cntxt.update(locals())
         return render_to_response("spatial/map_list.html", cntxt)
-    spatialmaps = spatialmaps.filter(effective_to=None).order_by("created_by", "name")
-    jsonmaps = []
-    for m in spatialmaps:
-        jsonmaps.append(m.as_json(user=request.user))
+    spatialmaps = spatialmaps.filter(effective_to=None).order_by("created_by", "name", "pk")
     if fmt == "json":
-        return http.HttpResponse(json.dumps(jsonmaps, cls=JSONEncoder), "application/json")
+        try:
+            rows, total = map_rows(spatialmaps, request.GET)
+        except ValueError as e:
+            return http.HttpResponseBadRequest(str(e))
+        response = http.HttpResponse(maps_text(rows, request.user), "application/json")
+        response["X-Total-Count"] = total
+        return response
     if fmt == "dict":
-        return jsonmaps
+        return maps_dict(map_rows(spatialmaps)[0], request.user)
+
+
+def catalogue_json(request, order, version):
+    '''
+    The json layer catalogue, merged from a shared cached list of system
+    layers and a small cached per user overlay (their own layers and maps).
+    Both are keyed on the catalogue version so edits show up straight away.
+    '''
+    systemkey = "layercatalogue.{0}.system".format(version)
+    system = cache.get(systemkey)
+    if system is None:
+        system = [(layer.created_by_id, layer.as_json()) for layer in system_layers(order)]
+        cache.set(systemkey, system, CATALOGUE_TIMEOUT)
+    userkey = "layercatalogue.{0}.user.{1}".format(version, request.user.pk)
+    overlay = cache.get(userkey)
+    if overlay is None:
+        overlay = {
+            "layers": [layer.as_json() for layer in user_layers(request, order)],
+            "maps": map_list(request, fmt="dict")
+        }
+        cache.set(userkey, overlay, CATALOGUE_TIMEOUT)
+    # with the old ordering the users own layers are listed first, not twice
+    own = request.user.pk if order.layers is None else None
+    return {
+        "layers": TRACKING_LAYERS + overlay["layers"] + [layer for created_by, layer in system if created_by != own],
+        "maps": overlay["maps"]
+    }
 
 
 @login_required
@@ -120,147 +146,77 @@ def layer_list(request, fmt="json", asobject=False):
     WMS one should contain the code to create the layer itself
     vector one should contain the code and url to retrieve features via geojson/wfs and sld file reference
     '''
-    cachekey = "layercache01" + fmt
-    if not settings.DEBUG and isinstance(cache.get(cachekey), dict):
-        response = http.HttpResponse(**cache.get(cachekey))
-        response["Cache-Control"] = "max-age=600, public"
-        return response
-    orderedloc = os.path.join(settings.STATIC_ROOT, "layerorder.json")
-    try:
-        orderedlayers = json.loads(open(orderedloc).read())["layers"]
-    except:
-        # so we know to use old layer ordering methods later
-        retro = True
-    else:
-        retro = False
-    cntxt = context(request)
-    layers = []
-    if retro:
-        # Vector layers outside of editable rasters should be deprecated soon
-        if asobject:
-            # return the list of layers as a python object if asobject (for layer organisation)
-            for layer_type in ["point", "line", "polygon", "overlay", "imagery"]: #nice ordering
-                layers += list(RasterLayer.objects.filter(effective_to=None, modified_by=1, layer_type=layer_type).order_by("name"))
-        else:
-            # don't add users layers if returning objects, just list system order
-            for layer_type in ["point", "line", "polygon", "overlay", "imagery"]: #nice ordering
-                layers += list(RasterLayer.objects.filter(effective_to=None, created_by=request.user, layer_type=layer_type).order_by("-date_created").exclude(layer_id__contains=request.user.username + "_resource_tracking"))
-            for layer_type in ["point", "line", "polygon", "overlay", "imagery"]: #nice ordering
-                layers += list(RasterLayer.objects.filter(effective_to=None, modified_by=1, layer_type=layer_type).exclude(created_by=request.user).order_by("name"))
-    else:
-        dictlayers = {"point": [], "line": [], "polygon": [], "overlay": [], "imagery": []}
-        for lyr in orderedlayers:
-        # ordered layers from file
-            layer = False
-            try:
-                layer = RasterLayer.objects.get(layer_id=lyr, effective_to = None)
-            except:
-                pass
-            if layer:
-                dictlayers[layer.metadata_type].append(layer)
-        for layer_type in ["point", "line", "polygon", "overlay", "imagery"]: #nice ordering
-            layers += dictlayers[layer_type]
-            layers += list(RasterLayer.objects.filter(effective_to = None, modified_by = 1, layer_type = layer_type).exclude(layer_id__in = orderedlayers).order_by("name"))
+    order = layer_order()
     if asobject:
-        return layers
-    trackingLayers = [{
-                "tags": "resource, tracking, week, symbols, default",
-                "style": "resource_tracking_symbols",
-                "style_history": "",
-                "cluster": 12,
-                "filters": None,
-                "query": "resource_tracking_week",
-                "unique": "deviceid",
-                "id": "resource_tracking_week_symbols_overlay",
-                "legend": "//static.dpaw.wa.gov.au/static/firesource/static/source/legends/resource_tracking_week_symbols_overlay.png",
-                "shown": True,
-                "name": "Resource Tracking - Symbols Overlay",
-                "details":
-            {
-                "updated": "Live",
-                "renderer": "layerdetails",
-                "legend_width": 600,
-                "tags": [
-                        "resource",
-                        "tracking",
-                        "week",
-                        "symbols"
-                    ]
-                },
-                "type": "vectoroverlay"
-            }, {
-                "tags": "resource, tracking, week, default",
-                "style": "resource_tracking",
-                "style_history": "vector_history",
-                "cluster": 12,
-                "filters":
-                {
-                    "Comms Bus": "symbol:device_comms_bus",
-                    "Heavy Duty": "symbol:device_heavy_duty",
-                    "Dozer": "symbol:device_dozer",
-                    "Gang Truck": "symbol:device_gang_truck",
-                    "Aviation": "group:aviation"
-                },
-                "query": "resource_tracking_week",
-                "unique": "deviceid",
-                "id": "resource_tracking_week_base",
-                "legend": "//static.dpaw.wa.gov.au/static/firesource/static/source/legends/resource_tracking_week_base.png",
-                "shown": True,
-                "name": "Resource Tracking",
-                "details":
-                {
-                    "updated": "Live",
-                    "positionalaccuracy": "Unknown",
-                    "description": "Resource tracking data showing points within the last week",
-                    "tags": [
-                            "resource",
-                            "tracking",
-                            "week"
-                        ],
-                        "custodian": "DPAW",
-                        "legend_width": 400,
-                        "source": "DPAW",
-                        "renderer": "layerdetails"
-                    },
-                    "type": "vector"
-            }]
+        # return the list of layers as a python object if asobject (for layer organisation)
+        return system_layers(order)
+    version = "{0}.{1}".format(catalogue_version(), order.version)
+    cachekey = "layercatalogue.{0}.{1}.{2}".format(version, fmt, request.user.pk)
+    payload = cache.get(cachekey)
+    if not settings.DEBUG and isinstance(payload, dict):
+        return payload_response(request, payload, payload["mimetype"], 0, public=False)
+    cntxt = context(request)
     if fmt == "html":
+        own = request.user.pk if order.layers is None else None
+        layers = user_layers(request, order) + [layer for layer in system_layers(order) if layer.created_by_id != own]
         cntxt.update({
             "columns": Layer.COLUMNS,
             "layers":layers,
             "user": request.user })
         response = render_to_response('spatial/layers.html', cntxt)
-        cache.set(cachekey, {"content":response.content}, 600)
-        return response
+        result = response.content
+        mimetype = response["Content-Type"]
     elif fmt == "json":
-        result = json.dumps({
-                "layers": trackingLayers + [layer.as_json() for layer in layers],
-                "maps": map_list(request, fmt="dict")
-            }, cls=JSONEncoder)
+        result = dumps(catalogue_json(request, order, version))
         mimetype = 'application/json'
-    response = http.HttpResponse(result, content_type=mimetype)
-    response["Cache-Control"] = "max-age=600, public"
-    cache.set(cachekey, {"content":response.content, "mimetype":mimetype}, 600)
-    return response
+    payload = cached_payload(result)
+    payload["mimetype"] = mimetype
+    cache.set(cachekey, payload, CATALOGUE_TIMEOUT)
+    return payload_response(request, payload, mimetype, 0, public=False)
 
 
 def query_vector_layer(request, layerid, mimetype='application/json'):
     if request.method == "POST":
         postdict = json.loads(request.body)
+        try:
+            check_history_options(postdict)
+        except ValueError as e:
+            return http.HttpResponseBadRequest(str(e))
+        if postdict.get("stream"):
+            return http.StreamingHttpResponse(stream_history(request, postdict), content_type=mimetype)
         content = remote_history(request,postdict)
         response = http.HttpResponse(content, content_type=mimetype)
         return response
-    else:
-        cachekey = "remote_devices_json"
-        if cache.get(cachekey):
-            response = http.HttpResponse(cache.get(cachekey), content_type=mimetype)
-            response["Cache-Control"] = "max-age=60, public"
-            return response
-        content = remote_devices(request)
-        cache.set(cachekey, content, 60)
+    elif "zoom" in request.GET or "resolution" in request.GET:
+        # clustered for the clients view, individual devices once zoomed in
+        try:
+            zoom = int(request.GET["zoom"]) if "zoom" in request.GET else None
+            resolution = float(request.GET["resolution"]) if "resolution" in request.GET else None
+            zoom = cluster_zoom(zoom, resolution)
+            bbox = parse_bbox(request.GET.get("bbox"))
+        except ValueError as e:
+            return http.HttpResponseBadRequest(str(e))
+        content = remote_devices_clustered(request, zoom, bbox)
         response = http.HttpResponse(content, content_type=mimetype)
         response["Cache-Control"] = "max-age=60, public"
         return response
+    elif "bbox" in request.GET:
+        try:
+            bbox = parse_bbox(request.GET["bbox"])
+        except ValueError as e:
+            return http.HttpResponseBadRequest(str(e))
+        content = remote_devices_bbox(request, bbox)
+        response = http.HttpResponse(content, content_type=mimetype)
+        response["Cache-Control"] = "max-age=60, public"
+        return response
+    elif "since" in request.GET:
+        # incremental poll, only devices changed since the clients token
+        content = remote_devices_since(request, request.GET["since"])
+        response = http.HttpResponse(content, content_type=mimetype)
+        response["Cache-Control"] = "max-age=60, public"
+        return response
+    else:
+        return payload_response(request, cached_remote_devices(request), mimetype, 60)
 
 
 def centerscale_topoly2(center, scale, docsize):
@@ -281,157 +237,112 @@ def centerscale_topoly2(center, scale, docsize):
     return poly.wkt
 
     return "POLYGON (({0.longitude} {0.latitude}, {1.longitude} {0.latitude}, {1.longitude} {1.latitude}, {0.longitude} {1.latitude}, {0.longitude} {0.latitude}))".format(topleft, bottomright)
-def centerscale_topoly(center, scale, docsize):
+@login_required
+def print(request, dpi=200, fmt="pdf"):
     '''
-    Takes a document size and center and scale, and generates a bounding box
-    for that scale and document size as a polygon in Well Known Text
+    If post create/end a map in database
+    If get print latest map for workdir specified
     '''
-    # calculate bounds from center and set them according to template
-    if not isinstance(center, distance.Point):
+    logger = print_logger
+    try:
+        spatial_state = json.loads(request.GET["ss"])
+    except:
+        return http.HttpResponse(subprocess.check_output([GDAL_TRANSLATE, "--version"]))
+    spatialmap = print_map(spatial_state, request.GET["name"], request.user)
+    key = print_key(spatial_state, spatialmap.name, request.user, spatialmap.template, dpi, fmt)
+    output = print_results.get(key, fmt)
+    if output is None:
+        cwd = os.getcwd()
+        workdir = os.path.join(WORKDIR_ROOT, spatialmap.workdir)
+        logger.info("Workdir: {0}".format(workdir))
+        # take lock for current folder/map
         try:
-            center = distance.Point(longitude=center.x,latitude=center.y)
+            os.makedirs(workdir)
+            os.chdir(workdir)
+            logger.info('Taking a lock in the workdir')
         except:
-            center = distance.Point(center)
-    width = distance.distance(meters = docsize[0] / 1000 * scale)
-    midleft = (width * 0.5).destination(center, 270)
-    topleft = distance.Point(longitude=midleft.longitude, latitude = center.latitude + (midleft.longitude - center.longitude) * (docsize[1]/docsize[0]))
-    bottomright = distance.Point(longitude=center.longitude + (center.longitude - midleft.longitude), latitude = center.latitude - (topleft.latitude - center.latitude))
-    return "POLYGON (({0.longitude} {0.latitude}, {1.longitude} {0.latitude}, {1.longitude} {1.latitude}, {0.longitude} {1.latitude}, {0.longitude} {0.latitude}))".format(topleft, bottomright)
+            return http.HttpResponse("Busy, please try later")
+        # grab user shared_id for login
+        wmsauth = "{}:{}".format(request.META["HTTP_REMOTE_USER"], request.META["HTTP_X_SHARED_ID"])
+        try:
+            output, mimetype, filename = render_print(spatialmap, workdir, dpi, fmt, wmsauth)
+        except PrintError as e:
+            os.chdir(cwd)
+            return http.HttpResponse(unicode(e))
+        output = print_results.put(key, fmt, output)
+        logger.info('Freeing the workdir lock')
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return print_file_response(output, MIMETYPES[fmt], spatialmap.name + "." + fmt)
+
 
-#@task
-def tile_wms(layer, extent, docsize, dpi, workdir, wmsauth):
+def print_file_response(output, mimetype, filename):
     '''
-    takes a layer and generates a tiled wms of that layer in the current dir for the
-    specified extent and template size
+    Streams a stored print, output is an open file or a path. A path
+    removed from print_results to make room is 410 Gone.
     '''
-    logger = logger_setup('tile_wms')
-    logger.info('Called with: {0}'.format((layer, extent, docsize, dpi, workdir)))
-    if layer.transparent:
-        layerimage, outputformat = layer.layer_id + ".png", "PNG"
-    else:
-        layerimage, outputformat = layer.layer_id + ".jpg", "JPEG"
-    sizex = docsize[0] / 25.4 * dpi
-    sizey = sizex * (extent[3] - extent[1]) / (extent[2] - extent[0])
-    layerurl = "http:" + layer.url.replace("gwc/service/wms", "ows")
-    logger.info('layerurl: {0}'.format(layerurl))
-    gdaltile = render_to_response('spatial/gdalwms.xml', locals())
-    logger.info('gdaltile:')
-    logger.info(gdaltile.content)
-    with open(layer.layer_id + ".xml", "w") as gdalfile:
-        gdalfile.write(gdaltile.content)
-    subprocess.check_call("gdal_translate -q -of {0} {1}.xml {2} && convert {2} -transparent white {2}".format(outputformat, layer.layer_id, layerimage), shell=True)
-    logger.info("layerimage creation successful: {0}".format(layerimage))
-    return layerimage
+    if not hasattr(output, "read"):
+        try:
+            output = open(output, "rb")
+        except IOError:
+            return http.HttpResponseGone("This print has expired, please print again")
+    response = http.FileResponse(output, content_type=mimetype)
+    response["Content-Length"] = os.fstat(output.fileno()).st_size
+    response["Content-Disposition"] = 'inline; filename="{}"'.format(filename)
+    return response
+
+
+def print_job_json(job):
+    status = {
+        "id": job["id"],
+        "status": job["status"],
+        "url": "/apps/spatial/print/jobs/{0}".format(job["id"])
+    }
+    if job["status"] == "queued":
+        status["position"] = print_queue.position(job)
+    elif job["status"] == "done":
+        status["result"] = status["url"] + "/result"
+    elif job["status"] == "failed":
+        status["error"] = job["error"]
+    return status
 
 
 @login_required
-def print(request, dpi=200, fmt="pdf"):
+def print_submit(request, dpi=200, fmt="pdf"):
     '''
-    If post create/end a map in database
-    If get print latest map for workdir specified
+    Queues a print of the map state in ss for the print workers, returns
+    the job status straight away
     '''
-    cachekey = "print.{}?{}".format(fmt, request.META["QUERY_STRING"])
-    cacheddata = cache.get(cachekey)
-    if cacheddata:
-        content, mimetype, filename = cacheddata
-        response = http.HttpResponse(content, content_type=mimetype)
-        response["Content-Disposition"] = 'inline; filename="{}"'.format(filename)
-        return response
-    logger = logger_setup('print')
     try:
         spatial_state = json.loads(request.GET["ss"])
-    except:
-        return http.HttpResponse(subprocess.check_output([GDAL_TRANSLATE, "--version"]))
-    cwd = os.getcwd()
-    spatialmap = Map(name=request.GET["name"], created_by=request.user, modified_by=request.user)
-    spatialmap.layers = spatial_state["layers"]
-    spatialmap.center = "POINT ({0} {1})".format(*spatial_state["center"]["coordinates"])
-    spatialmap.scale = int(spatial_state["scale"])
-    spatialmap.workdir = spatialmap.created_by.email + "-sssprint-" + spatialmap.date_created.strftime("%Y%m%d_%H%M")
-    spatialmap.template = "inkscape_a3_landscape"
-    workdir = os.path.join("/run/shm", spatialmap.workdir)
-    logger.info("Workdir: {0}".format(workdir))
-    # take lock for current folder/map
-    try:
-        os.makedirs(workdir)
-        os.chdir(workdir)
-        logger.info('Taking a lock in the workdir')
-    except:
-        return http.HttpResponse("Busy, please try later")
-    docsize = document_sizes[spatialmap.template]
-    spatialmap.bounds = centerscale_topoly(spatialmap.center, spatialmap.scale, docsize)
-    # find out projection for printing eastings/northings
-    srid = False
-    if spatialmap.center.x > 108 and spatialmap.center.x <= 114: srid = 28349
-    elif spatialmap.center.x > 114 and spatialmap.center.x <= 120: srid = 28350
-    elif spatialmap.center.x > 120 and spatialmap.center.x <= 126: srid = 28351
-    elif spatialmap.center.x > 126 and spatialmap.center.x <= 132: srid = 28352
-    elif spatialmap.center.x > 132 and spatialmap.center.x <= 138: srid = 28353
-    elif spatialmap.center.x > 138 and spatialmap.center.x <= 144: srid = 28354
-    elif spatialmap.center.x > 144 and spatialmap.center.x <= 150: srid = 28355
-    elif spatialmap.center.x > 150 and spatialmap.center.x <= 156: srid = 28356
-    class bnds: pass
-    bnds.xmin, bnds.ymin = round(spatialmap.bounds.extent[0], 5), round(spatialmap.bounds.extent[1], 5)
-    bnds.xmid, bnds.ymid = round(spatialmap.center.x, 5), round(spatialmap.center.y, 5)
-    bnds.xmax, bnds.ymax = round(spatialmap.bounds.extent[2], 5), round(spatialmap.bounds.extent[3], 5)
-    # pbnds is projected bounds
-    if srid:
-        class pbnds: pass
-        from django.contrib.gis.geos.point import Point
-        pbnds.xmin, pbnds.ymin = Point(bnds.xmin, bnds.ymin, srid=4283).transform(srid, clone=True)
-        pbnds.xmid, pbnds.ymid = Point(bnds.xmid, bnds.ymid, srid=4283).transform(srid, clone=True)
-        pbnds.xmax, pbnds.ymax = Point(bnds.xmax, bnds.ymax, srid=4283).transform(srid, clone=True)
-        pbnds.xmin, pbnds.ymin = int(round(pbnds.xmin, 0)), int(round(pbnds.ymin, 0))
-        pbnds.xmid, pbnds.ymid = int(round(pbnds.xmid, 0)), int(round(pbnds.ymid, 0))
-        pbnds.xmax, pbnds.ymax = int(round(pbnds.xmax, 0)), int(round(pbnds.ymax, 0))
-    # calculate this from scalebars/km given scalebar is 0.2m
-    scalebar_kms = round(spatialmap.scale / 5000, 2)
-    # this should asjust for users local time not servers local time. Users offset should be set automatically on map load by browsers offset.
-    spatialmap_datetime = datetime.fromtimestamp(time.mktime(time.localtime(calendar.timegm(spatialmap.date_created.timetuple())))).strftime("%a, %d %b %Y %H:%M")
-    # Well this is needlessly complex:
-    #compositepng, compositejpg, compositepdf, zipped = [(n+".png",n+".jpg",n+".pdf",n+".zip") for n in [spatialmap.map_id + spatialmap.date_created.strftime("_%Y%m%d_%H%M")]][0]
-    composite = spatialmap.map_id + spatialmap.date_created.strftime("_%Y%m%d_%H%M")
-    compositepng = "{0}.png".format(composite)
-    compositejpg = "{0}.jpg".format(composite)
-    compositepdf = "{0}.pdf".format(composite)
-    # grab user shared_id for login
-    wmsauth = "{}:{}".format(request.META["HTTP_REMOTE_USER"], request.META["HTTP_X_SHARED_ID"])
-    logger.info("Starting to iterate through layers: {0}".format(spatialmap.layers))
-    for index, lyr in enumerate(spatialmap.layers):
-        logger.info("Layer: {0}".format(lyr))
-        if not RasterLayer.objects.filter(url__startswith="//kmi.dpaw.wa.gov.au/", layer_id=lyr["layer_id"]).order_by("-effective_from").exists():
-            if lyr["layer_id"].startswith("resource_tracking_week_base"):
-                lyr["layer_id"] = "resource_tracking_printable"
-            else:
-                continue
-        layer = RasterLayer.objects.filter(layer_id=lyr["layer_id"]).order_by("-effective_from")[0]
-        logger.info("Layer {0} is a raster layer, call tile_wms".format(layer))
-        try:
-            lyr["location"] = tile_wms(layer=layer, extent=spatialmap.bounds.extent, docsize=docsize, dpi=dpi, workdir=workdir, wmsauth=wmsauth)
-        except Exception as e:
-            os.chdir(cwd)
-            return http.HttpResponse("<h2>Layer <u>{0}</u> failed to render, try zooming in or disabling this layer and printing again.</h2>workdir: <pre>{1}</pre><br>error: <pre>{2}</pre>".format(layer.name, workdir, e))
-    finalpng = "inkscape_" + compositepng
-    finaljpg = "inkscape_" + compositejpg
-    finalsvg = finaljpg.replace(".jpg", ".svg")
-    finalpdf = "inkscape_" + compositepdf
-    with open(finalsvg, "w") as inkscapesvg:
-        inkscapesvg.write(render_to_response('spatial/{0}.svg'.format(spatialmap.template), locals()).content)
-    if fmt == "pdf":
-        subprocess.check_call("inkscape {0} --export-dpi={2} --export-pdf={1}".format(finalsvg, finalpdf, dpi), shell=True)
-        content = open(finalpdf).read()
-        mimetype = "application/pdf"
-        filename = spatialmap.name + ".pdf"
-    elif fmt == "jpg":
-        subprocess.check_call("inkscape {0} --export-dpi={2} --export-png={1} && convert {1} -quality 100% {3}".format(finalsvg, finalpng, dpi, finaljpg), shell=True)
-        content = open(finaljpg).read()
-        mimetype = "image/jpg"
-        filename = spatialmap.name + ".jpg"
-    cache.set(cachekey, (content, mimetype, filename), 600)
-    response = http.HttpResponse(content, content_type=mimetype)
-    response["Content-Disposition"] = 'inline; filename="{}"'.format(filename)
-    logger.info('Freeing the workdir lock')
-    os.chdir(cwd)
-    shutil.rmtree(workdir)
+    except (KeyError, ValueError):
+        return http.HttpResponseBadRequest("ss must be a map state")
+    if fmt not in MIMETYPES:
+        return http.HttpResponseBadRequest("fmt must be one of {0}".format(", ".join(sorted(MIMETYPES))))
+    job_id = print_queue.submit({
+        "state": spatial_state,
+        "name": request.GET.get("name", ""),
+        "user": request.user.pk,
+        "dpi": dpi,
+        "fmt": fmt,
+        "wmsauth": "{}:{}".format(request.META["HTTP_REMOTE_USER"], request.META["HTTP_X_SHARED_ID"])
+    })
+    response = http.HttpResponse(json.dumps(print_job_json(print_queue.get(job_id))), "application/json", status=202)
+    response["Location"] = "/apps/spatial/print/jobs/{0}".format(job_id)
     return response
 
+
+@login_required
+def print_status(request, job_id):
+    job = print_queue.get(job_id)
+    if job is None or job["user"] != request.user.pk:
+        raise http.Http404("No print job {0}".format(job_id))
+    return http.HttpResponse(json.dumps(print_job_json(job)), "application/json")
+
+
+@login_required
+def print_result(request, job_id):
+    job = print_queue.get(job_id)
+    if job is None or job["user"] != request.user.pk or job["status"] != "done":
+        raise http.Http404("Print job {0} isn't done".format(job_id))
+    return print_file_response(job["path"], job["mimetype"], job["filename"])